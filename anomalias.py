@@ -0,0 +1,289 @@
+"""Detecção de gastos fora do padrão (mediana móvel + MAD) por Categoria e por Cartão.
+
+Fica fora do app.py para poder ser usado sem o Streamlit, inclusive como job em
+lote sobre o histórico inteiro:
+
+    python anomalias.py --linhas 1000000 --orcamento 30
+
+Cada despesa é comparada com as `janela` despesas anteriores do mesmo grupo
+(mesma Categoria ou mesmo Cartão) pelo z-score robusto 0.6745 * (x - mediana) / MAD,
+com x = log(1 + gasto): gastos variam de forma multiplicativa, então o score mede
+"quantas vezes maior que o normal" e um cartão que mistura categorias baratas e
+caras não vira uma fonte de alarmes. Meses de cada Categoria são comparados da
+mesma forma com os meses anteriores.
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+DIMENSOES = ["Categoria", "Cartao"]
+JANELA_TRANSACOES = 30  # despesas anteriores do mesmo grupo usadas como referência
+JANELA_MESES = 12
+MIN_PERIODOS = 8  # abaixo disso o grupo ainda não tem histórico suficiente para julgar
+LIMIAR_SCORE = 3.5  # corte usual para o z-score modificado (Iglewicz e Hoaglin)
+MAD_MINIMO = 0.05  # em log: evita scores infinitos em grupos com valores quase constantes
+TAMANHO_BLOCO = 200_000  # linhas por bloco no cálculo das janelas (limita a memória)
+
+COLUNAS_ANOMALIAS = ["id", "Data", "Descricao", "Dimensao", "Grupo", "Gasto", "Mediana", "Score"]
+COLUNAS_ANOMALIAS_MENSAIS = ["Categoria", "MesAno", "Gasto", "Mediana", "Score"]
+COLUNAS_TOTAIS_MENSAIS = ["Categoria", "MesAno", "Gasto"]
+
+
+def rolling_robust_scores(valores, grupos, janela, min_periodos=MIN_PERIODOS):
+    """Mediana, MAD e score de cada posição contra as `janela` posições anteriores do mesmo grupo.
+
+    `valores` e `grupos` devem estar ordenados por grupo e, dentro do grupo, por
+    tempo. As janelas são montadas com sliding_window_view sobre o vetor inteiro
+    e mascaradas onde atravessariam o início do grupo; a mediana sai de um sort
+    por linha, então não há laço Python por linha nem por grupo.
+    """
+    valores = np.asarray(valores, dtype=float)
+    grupos = np.asarray(grupos)
+    n = len(valores)
+    mediana = np.full(n, np.nan)
+    mad = np.full(n, np.nan)
+    if n == 0:
+        return mediana, mad, np.full(n, np.nan)
+
+    # Posição de cada linha dentro do seu grupo
+    indices = np.arange(n)
+    inicio_grupo = np.r_[True, grupos[1:] != grupos[:-1]]
+    posicao = indices - np.maximum.accumulate(np.where(inicio_grupo, indices, 0))
+
+    # janelas[i] = valores[i - janela : i] (com NaN à esquerda do começo do vetor)
+    janelas = sliding_window_view(np.r_[np.full(janela, np.nan), valores], janela)[:n]
+    offsets = np.arange(janela)
+
+    for ini in range(0, n, TAMANHO_BLOCO):
+        fim = min(ini + TAMANHO_BLOCO, n)
+        bloco = janelas[ini:fim]
+        validos = offsets >= (janela - posicao[ini:fim])[:, None]
+        contagem = validos.sum(axis=1)
+
+        bloco = np.sort(np.where(validos, bloco, np.nan), axis=1)  # NaN vão para o fim de cada linha
+        med = _median_sorted(bloco, contagem)
+        desvios = np.sort(np.abs(bloco - med[:, None]), axis=1)
+        dev = _median_sorted(desvios, contagem)
+
+        suficiente = contagem >= min_periodos
+        mediana[ini:fim] = np.where(suficiente, med, np.nan)
+        mad[ini:fim] = np.where(suficiente, dev, np.nan)
+
+    score = 0.6745 * (valores - mediana) / np.maximum(mad, MAD_MINIMO)
+    return mediana, mad, score
+
+
+def _median_sorted(ordenado, contagem):
+    """Mediana das `contagem` primeiras colunas de cada linha de uma matriz já ordenada."""
+    linhas = np.arange(len(ordenado))
+    baixo = np.clip((contagem - 1) // 2, 0, None)
+    alto = np.clip(contagem // 2, 0, ordenado.shape[1] - 1)
+    with np.errstate(invalid="ignore"):
+        return np.where(contagem > 0, (ordenado[linhas, baixo] + ordenado[linhas, alto]) / 2, np.nan)
+
+
+def expense_rows(df):
+    """Despesas no formato usado pelo detector (gasto positivo), sem 'Fatura Cartão'."""
+    despesas = df[(df["Valor"] < 0) & (df["Categoria"] != "Fatura Cartão")]
+    return pd.DataFrame({
+        "id": despesas["id"].to_numpy(),
+        "Data": pd.to_datetime(despesas["Data"]).to_numpy(),
+        "Descricao": despesas["Descricao"].to_numpy() if "Descricao" in despesas else "",
+        "Categoria": despesas["Categoria"].to_numpy(),
+        "Cartao": despesas["Cartao"].to_numpy(),
+        "Gasto": -despesas["Valor"].to_numpy(dtype=float),
+    })
+
+
+def _score_dimension(despesas, dimensao, janela, novas=None):
+    """Pontua as despesas em uma dimensão; se `novas` for dado, só essas linhas são devolvidas."""
+    ordenado = despesas.sort_values([dimensao, "Ordem", "Data", "id"], kind="stable") \
+        if "Ordem" in despesas else despesas.sort_values([dimensao, "Data", "id"], kind="stable")
+    codigos, _ = pd.factorize(ordenado[dimensao])
+    mediana, _, score = rolling_robust_scores(np.log1p(ordenado["Gasto"].to_numpy()), codigos, janela)
+
+    resultado = pd.DataFrame({
+        "id": ordenado["id"].to_numpy(),
+        "Data": ordenado["Data"].to_numpy(),
+        "Descricao": ordenado["Descricao"].to_numpy(),
+        "Dimensao": dimensao,
+        "Grupo": ordenado[dimensao].to_numpy(),
+        "Gasto": ordenado["Gasto"].to_numpy(),
+        "Mediana": np.expm1(mediana),
+        "Score": score,
+    })
+    if novas is not None:
+        resultado = resultado[ordenado["Ordem"].to_numpy() == 1]
+    return resultado
+
+
+def score_transactions(df, janela=JANELA_TRANSACOES, limiar=LIMIAR_SCORE):
+    """Modo lote: pontua todas as despesas de `df` por Categoria e por Cartão e devolve as anômalas."""
+    despesas = expense_rows(df)
+    if despesas.empty:
+        return pd.DataFrame(columns=COLUNAS_ANOMALIAS)
+    pontuadas = pd.concat([_score_dimension(despesas, d, janela) for d in DIMENSOES], ignore_index=True)
+    return pontuadas[pontuadas["Score"] > limiar].reset_index(drop=True)
+
+
+def empty_monthly_totals():
+    # Gasto float mesmo vazio: senão o concat do update herda dtype object e o log1p falha
+    return pd.DataFrame(columns=COLUNAS_TOTAIS_MENSAIS).astype({"Gasto": float})
+
+
+def monthly_totals(df):
+    """Gasto por Categoria x MesAno ('YYYY-MM')."""
+    despesas = expense_rows(df)
+    if despesas.empty:
+        return empty_monthly_totals()
+    despesas["MesAno"] = despesas["Data"].dt.to_period("M").astype(str)
+    return despesas.groupby(["Categoria", "MesAno"], as_index=False)["Gasto"].sum()
+
+
+def score_category_months(totais, janela=JANELA_MESES, limiar=LIMIAR_SCORE):
+    """Pontua cada mês de cada Categoria contra os `janela` meses anteriores (meses sem gasto contam como 0)."""
+    if totais.empty:
+        return pd.DataFrame(columns=COLUNAS_ANOMALIAS_MENSAIS)
+    grade = totais.pivot_table(index="Categoria", columns="MesAno", values="Gasto", aggfunc="sum")
+    meses = pd.period_range(min(grade.columns), max(grade.columns), freq="M").astype(str)
+    grade = grade.reindex(columns=pd.Index(meses, name="MesAno"), fill_value=0.0).fillna(0.0)
+
+    longo = grade.stack().rename("Gasto").reset_index()  # ordenado por Categoria e MesAno
+    codigos, _ = pd.factorize(longo["Categoria"])
+    mediana, _, score = rolling_robust_scores(
+        np.log1p(longo["Gasto"].to_numpy()), codigos, janela, min_periodos=min(MIN_PERIODOS, janela)
+    )
+    longo["Mediana"], longo["Score"] = np.expm1(mediana), score
+    return longo[longo["Score"] > limiar][COLUNAS_ANOMALIAS_MENSAIS].reset_index(drop=True)
+
+
+class IncrementalAnomalyDetector:
+    """Mantém o estado do detector e pontua só as transações novas.
+
+    Guarda, por dimensão, as últimas `janela` despesas de cada grupo e o total
+    mensal por Categoria. `fit` roda o lote sobre o histórico; `update` recebe
+    apenas as linhas com id > `ultimo_id` e as pontua contra esse estado, como se
+    tivessem chegado depois do histórico já visto. Edições e exclusões mudam o
+    passado, então exigem `reset` e um novo `fit`.
+    """
+
+    def __init__(self, janela=JANELA_TRANSACOES, janela_meses=JANELA_MESES, limiar=LIMIAR_SCORE):
+        self.janela = janela
+        self.janela_meses = janela_meses
+        self.limiar = limiar
+        self.lock = threading.Lock()
+        self._limpar()
+
+    def reset(self):
+        # Espera um fit/update em andamento (quem os chama segura `lock`); sem isso o fit
+        # terminaria depois do reset e gravaria por cima o estado do histórico antigo
+        with self.lock:
+            self._limpar()
+
+    def _limpar(self):
+        self.ultimo_id = 0
+        self.ajustado = False
+        self.caudas = {d: pd.DataFrame() for d in DIMENSOES}
+        self.totais_mensais = empty_monthly_totals()
+        self.anomalias = pd.DataFrame(columns=COLUNAS_ANOMALIAS)
+        self.anomalias_mensais = pd.DataFrame(columns=COLUNAS_ANOMALIAS_MENSAIS)
+
+    def fit(self, df):
+        despesas = expense_rows(df)
+        self.anomalias = score_transactions(df, self.janela, self.limiar)
+        for d in DIMENSOES:
+            self.caudas[d] = despesas.sort_values([d, "Data", "id"]).groupby(d).tail(self.janela)
+        self.totais_mensais = monthly_totals(df)
+        self.anomalias_mensais = score_category_months(self.totais_mensais, self.janela_meses, self.limiar)
+        self.ultimo_id = int(df["id"].max()) if not df.empty else 0
+        self.ajustado = True
+
+    def update(self, df_novas):
+        if df_novas.empty:
+            return
+        novas = expense_rows(df_novas)
+        if novas.empty:
+            self.ultimo_id = max(self.ultimo_id, int(df_novas["id"].max()))
+            return
+
+        # Tudo é calculado em variáveis locais e só atribuído no fim: se algo falhar, o estado
+        # (inclusive ultimo_id) fica como estava e o próximo update tenta de novo as mesmas linhas
+        anomalias = [self.anomalias]
+        caudas = {}
+        for d in DIMENSOES:
+            cauda = self.caudas[d]
+            tocados = cauda[d].isin(novas[d]) if not cauda.empty else np.zeros(0, dtype=bool)
+            combinado = pd.concat(
+                [cauda[tocados].assign(Ordem=0), novas.assign(Ordem=1)], ignore_index=True
+            )
+            pontuadas = _score_dimension(combinado, d, self.janela, novas=True)
+            anomalias.append(pontuadas[pontuadas["Score"] > self.limiar])
+            nova_cauda = combinado.sort_values([d, "Ordem", "Data", "id"]).groupby(d).tail(self.janela)
+            caudas[d] = pd.concat(
+                [cauda[~tocados], nova_cauda.drop(columns="Ordem")], ignore_index=True
+            )
+
+        # Os totais mensais são pequenos (categorias x meses): soma-se o novo e repontua-se só essa grade
+        totais = pd.concat([self.totais_mensais, monthly_totals(df_novas)], ignore_index=True) \
+            .groupby(["Categoria", "MesAno"], as_index=False)["Gasto"].sum().astype({"Gasto": float})
+        anomalias_mensais = score_category_months(totais, self.janela_meses, self.limiar)
+
+        self.anomalias = pd.concat(anomalias, ignore_index=True)
+        self.caudas = caudas
+        self.totais_mensais = totais
+        self.anomalias_mensais = anomalias_mensais
+        self.ultimo_id = max(self.ultimo_id, int(df_novas["id"].max()))
+
+
+def synthetic_ledger(linhas, seed=0):
+    """Livro-caixa sintético (despesas log-normais por categoria) para o benchmark."""
+    rng = np.random.default_rng(seed)
+    categorias = np.array(["Alimentação", "Transporte", "Lazer", "Saúde", "Educação", "Compras", "Outros"])
+    cartoes = np.array(["Nenhum (Débito/Dinheiro)", "Nubank", "Mercado Pago", "C6", "Elo", "Azul", "Caju", "Outro"])
+    cat = rng.integers(0, len(categorias), linhas)
+    base = np.array([40, 25, 80, 120, 300, 150, 60], dtype=float)[cat]
+    valor = -np.round(base * rng.lognormal(0, 0.5, linhas), 2)
+    surtos = rng.random(linhas) < 0.001
+    valor[surtos] *= 20
+    datas = np.datetime64("2016-01-01") + rng.integers(0, 3650, linhas).astype("timedelta64[D]")
+    return pd.DataFrame({
+        "id": np.arange(1, linhas + 1),
+        "Data": datas,
+        "Categoria": categorias[cat],
+        "Descricao": "sintético",
+        "Valor": valor,
+        "Cartao": cartoes[rng.integers(0, len(cartoes), linhas)],
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do detector de anomalias em lote.")
+    parser.add_argument("--linhas", type=int, default=1_000_000)
+    parser.add_argument("--orcamento", type=float, default=30.0, help="Tempo máximo aceito (s) para o lote.")
+    args = parser.parse_args(argv)
+
+    df = synthetic_ledger(args.linhas)
+    inicio = time.perf_counter()
+    detector = IncrementalAnomalyDetector()
+    detector.fit(df)
+    tempo_lote = time.perf_counter() - inicio
+
+    novas = synthetic_ledger(1000, seed=1).assign(id=lambda d: d["id"] + args.linhas)
+    inicio = time.perf_counter()
+    detector.update(novas)
+    tempo_incremental = time.perf_counter() - inicio
+
+    print(f"Lote: {args.linhas} linhas em {tempo_lote:.2f}s "
+          f"({len(detector.anomalias)} transações e {len(detector.anomalias_mensais)} meses anômalos)")
+    print(f"Incremental: 1000 linhas novas em {tempo_incremental * 1000:.0f}ms")
+    if tempo_lote > args.orcamento:
+        print(f"ACIMA DO ORÇAMENTO de {args.orcamento:.0f}s")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,25 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import sqlite3 # Importado para o fallback local
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from collections import OrderedDict
 import os
+import threading
 from sqlalchemy.sql import text # Importante para executar SQL
+from anomalias import IncrementalAnomalyDetector
+from duplicados import transaction_fingerprint, find_near_duplicates, COLUNAS_DUPLICATAS, JANELA_DIAS_DUPLICATAS, SIMILARIDADE_MINIMA
+from consultas import (  # camada de dados compartilhada com load_test_sqlite.py
+    CATEGORIAS_RECEITA, CATEGORIAS_DESPESA, CARTOES, CARTOES_CREDITO, LINHAS_POR_PAGINA,
+    connect_sqlite, execute_with_retry,
+    DIA_FECHAMENTO_PADRAO, SQLITE_TABELAS, SQL_INDICE_FINGERPRINT, SQL_CONCILIACAO, MES_FATURA_SQL,
+    SQL_LOAD_TRANSACTIONS, SQL_LOAD_ALL_TRANSACTIONS, SQL_LOAD_TRANSACTIONS_SINCE, SQL_FIND_FINGERPRINT,
+    SQL_SAVE_TRANSACTION, SQL_UPDATE_TRANSACTION, SQL_DELETE_TRANSACTION, SQL_LOAD_NEAR_DUPLICATES,
+    SQL_LOAD_FATURAS, SQL_LOAD_BUDGETS, SQL_LOAD_MONTHLY_BUDGETS, SQL_LOAD_MONTHLY_SPENDING, SQL_LOAD_CLOSING_DAYS,
+    SQL_LOAD_CYCLE_TRANSACTIONS, SQL_LOAD_RECURRING_RULES, SQL_LOAD_INSTALLMENTS, SQL_LOAD_CURRENT_BALANCE,
+    SQL_LOAD_DATE_BOUNDS, SQL_LOAD_DAILY_BALANCE, sqlite_reconciliation_query
+)
 
 # --- Configuração da Página ---
 st.set_page_config(
@@ -15,22 +30,33 @@ st.set_page_config(
 )
 
 # --- Constantes ---
-CATEGORIAS_RECEITA = [
-    "Salário", "Freelance", "Investimentos", "Presente", "Conta Corrente", 
-    "Caju", "Outros"
-]
-CATEGORIAS_DESPESA = [
-    "Alimentação", "Transporte", "Lazer", "Saúde", "Educação", 
-    "Compras", "Fatura Cartão", "Outros"
-]
-CARTOES = [
-    "Nenhum (Débito/Dinheiro)", "Nubank", "Mercado Pago", "C6", 
-    "Elo", "Azul", "Caju", "Outro"
-]
-
+# CATEGORIAS_RECEITA, CATEGORIAS_DESPESA, CARTOES, CARTOES_CREDITO e LINHAS_POR_PAGINA vêm de consultas.py
 COLUNAS_TRANSACOES = ["id", "Data", "Categoria", "Descricao", "Valor", "Cartao"]
+POLITICAS_DUPLICADOS = ["sinalizar", "rejeitar", "permitir"]  # o que fazer ao salvar uma transação com fingerprint já existente
 COLUNAS_FATURAS = ["id", "Cartao", "MesAno", "ValorFatura"]
 COLUNAS_ORCAMENTOS = ["Categoria", "Valor"]
+COLUNAS_ORCAMENTOS_MENSAIS = ["Categoria", "MesAno", "Valor"]
+COLUNAS_GASTOS_MENSAIS = ["Categoria", "MesAno", "Gasto"]
+COLUNAS_RECORRENCIAS = ["id", "Descricao", "Categoria", "Valor", "Cartao", "Inicio", "Fim"]
+COLUNAS_PARCELAMENTOS = ["id", "Descricao", "Categoria", "ValorTotal", "NumParcelas", "DataCompra", "Cartao"]
+COLUNAS_FECHAMENTO = ["Cartao", "DiaFechamento"]
+COLUNAS_CONCILIACAO = ["Cartao", "MesAno", "ValorFatura", "ValorGastos", "NumTransacoes"]
+
+# --- Conciliação de faturas ---
+TOLERANCIA_CONCILIACAO = 0.01  # R$
+
+# --- Concorrência do SQLite (ajustável por variáveis de ambiente; meça com load_test_sqlite.py) ---
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MAX_RETRIES = int(os.environ.get("SQLITE_MAX_RETRIES", "5"))
+SQLITE_RETRY_BACKOFF = float(os.environ.get("SQLITE_RETRY_BACKOFF", "0.05"))  # segundos, dobra a cada tentativa
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "")  # ex: "WAL"; vazio mantém o modo atual do arquivo
+
+# --- Séries temporais ---
+LARGURA_GRAFICO_PX = 1000  # Máximo de pontos enviados ao navegador por série (~1 ponto por pixel)
+COLUNAS_SALDO_DIARIO = ["Data", "Fluxo", "Saldo"]
+
+# --- Cache de transações por intervalo ---
+CACHE_TRANSACOES_MAX_MB = float(os.environ.get("CACHE_TRANSACOES_MAX_MB", "64"))
 
 # =====================================================================
 # --- CONEXÃO SQL (st.connection) ---
@@ -47,7 +73,11 @@ except Exception as e:
     def get_db_connection_sqlite():
         base_dir = os.path.dirname(os.path.abspath(__file__))
         db_path = os.path.join(base_dir, DB_NAME)
-        return sqlite3.connect(db_path, check_same_thread=False)
+        return connect_sqlite(db_path, SQLITE_BUSY_TIMEOUT_MS)
+
+def run_sqlite_with_retry(operacao):
+    """Executa `operacao(db_conn)` em uma conexão nova, repetindo com backoff se o banco estiver bloqueado."""
+    return execute_with_retry(get_db_connection_sqlite, operacao, SQLITE_MAX_RETRIES, SQLITE_RETRY_BACKOFF)
 
 @st.cache_resource
 def init_db():
@@ -58,7 +88,7 @@ def init_db():
                 s.execute(text("""
                 CREATE TABLE IF NOT EXISTS transacoes (
                     id SERIAL PRIMARY KEY, Data DATE NOT NULL, Categoria TEXT NOT NULL,
-                    Descricao TEXT, Valor REAL NOT NULL, Cartao TEXT DEFAULT 'N/A'
+                    Descricao TEXT, Valor REAL NOT NULL, Cartao TEXT DEFAULT 'N/A', Fingerprint TEXT
                 )"""))
                 s.execute(text("""
                 CREATE TABLE IF NOT EXISTS faturas (
@@ -67,65 +97,284 @@ def init_db():
                 s.execute(text("""
                 CREATE TABLE IF NOT EXISTS orcamentos ( Categoria TEXT PRIMARY KEY, Valor REAL NOT NULL )
                 """))
+                s.execute(text("""
+                CREATE TABLE IF NOT EXISTS recorrencias (
+                    id SERIAL PRIMARY KEY, Descricao TEXT, Categoria TEXT NOT NULL, Valor REAL NOT NULL,
+                    Cartao TEXT DEFAULT 'N/A', Inicio DATE NOT NULL, Fim DATE
+                )"""))
+                s.execute(text("""
+                CREATE TABLE IF NOT EXISTS parcelamentos (
+                    id SERIAL PRIMARY KEY, Descricao TEXT, Categoria TEXT NOT NULL, ValorTotal REAL NOT NULL,
+                    NumParcelas INTEGER NOT NULL, DataCompra DATE NOT NULL, Cartao TEXT DEFAULT 'N/A'
+                )"""))
+                s.execute(text("""
+                CREATE TABLE IF NOT EXISTS cartoes_fechamento ( Cartao TEXT PRIMARY KEY, DiaFechamento INTEGER NOT NULL )
+                """))
+                s.execute(text("CREATE INDEX IF NOT EXISTS idx_transacoes_cartao_data ON transacoes (Cartao, Data)"))
+                s.execute(text("CREATE INDEX IF NOT EXISTS idx_faturas_cartao_mesano ON faturas (Cartao, MesAno)"))
+                s.execute(text("""
+                CREATE TABLE IF NOT EXISTS orcamentos_mensais (
+                    Categoria TEXT NOT NULL, MesAno TEXT NOT NULL, Valor REAL NOT NULL, PRIMARY KEY (Categoria, MesAno)
+                )"""))
+                # Bancos criados antes do fingerprint: adiciona a coluna e preenche as linhas antigas
+                s.execute(text("ALTER TABLE transacoes ADD COLUMN IF NOT EXISTS Fingerprint TEXT"))
+                s.execute(text("CREATE INDEX IF NOT EXISTS idx_transacoes_fingerprint ON transacoes (Fingerprint)"))
+                pendentes = s.execute(text(
+                    "SELECT id, Data, Descricao, Valor, Cartao FROM transacoes WHERE Fingerprint IS NULL"
+                )).fetchall()
+                if pendentes:
+                    s.execute(
+                        text("UPDATE transacoes SET Fingerprint = :fp WHERE id = :id"),
+                        [dict(fp=transaction_fingerprint(d, desc, v, c), id=i) for i, d, desc, v, c in pendentes]
+                    )
                 s.commit()
         else: 
-            db_conn = get_db_connection_sqlite()
-            cursor = db_conn.cursor()
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS transacoes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, Data TEXT NOT NULL, Categoria TEXT NOT NULL,
-                Descricao TEXT, Valor REAL NOT NULL, Cartao TEXT DEFAULT 'N/A'
-            )""")
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS faturas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, Cartao TEXT NOT NULL, MesAno TEXT NOT NULL, ValorFatura REAL NOT NULL
-            )""")
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS orcamentos ( Categoria TEXT PRIMARY KEY, Valor REAL NOT NULL )
-            """)
-            db_conn.commit()
-            db_conn.close()
+            def criar_tabelas(db_conn):
+                cursor = db_conn.cursor()
+                if SQLITE_JOURNAL_MODE:
+                    cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+                for ddl in SQLITE_TABELAS:
+                    cursor.execute(ddl)
+                # Bancos criados antes do fingerprint: adiciona a coluna e preenche as linhas antigas
+                colunas = [linha[1] for linha in cursor.execute("PRAGMA table_info(transacoes)")]
+                if "Fingerprint" not in colunas:
+                    cursor.execute("ALTER TABLE transacoes ADD COLUMN Fingerprint TEXT")
+                cursor.execute(SQL_INDICE_FINGERPRINT)
+                pendentes = cursor.execute(
+                    "SELECT id, Data, Descricao, Valor, Cartao FROM transacoes WHERE Fingerprint IS NULL"
+                ).fetchall()
+                cursor.executemany(
+                    "UPDATE transacoes SET Fingerprint = ? WHERE id = ?",
+                    [(transaction_fingerprint(d, desc, v, c), i) for i, d, desc, v, c in pendentes]
+                )
+            run_sqlite_with_retry(criar_tabelas)
     except Exception as e:
         st.error(f"Erro ao inicializar o banco de dados: {e}")
 
+# --- Cache de Transações por Intervalo ---
+class TransactionRangeCache:
+    """Cache de `load_transactions` por intervalo de datas, compartilhado entre as sessões.
+
+    Guarda intervalos disjuntos [inicio, fim] com as transações correspondentes.
+    Um pedido contido em um intervalo já carregado é atendido por fatiamento; um
+    pedido que sobrepõe ou encosta em intervalos existentes busca no banco só os
+    trechos que faltam e funde tudo em um único intervalo. A memória total é
+    limitada a `max_bytes`, removendo os intervalos usados há mais tempo (LRU).
+
+    A busca no banco roda fora do lock. `geracao` é incrementada a cada clear():
+    se mudou durante a busca (houve escrita), o resultado é devolvido mas não é
+    guardado; o mesmo vale se outra sessão guardou nesse meio tempo um intervalo
+    que encosta no novo, para os intervalos continuarem disjuntos.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.intervalos = OrderedDict()  # (inicio, fim) -> (DataFrame, bytes), do menos para o mais usado
+        self.lock = threading.Lock()
+        self.geracao = 0
+        self.hits = self.parciais = self.misses = self.evictions = 0
+
+    def get(self, start_date, end_date, fetch):
+        inicio, fim = date.fromisoformat(start_date), date.fromisoformat(end_date)
+        if inicio > fim:
+            return pd.DataFrame(columns=COLUNAS_TRANSACOES)
+
+        with self.lock:
+            geracao = self.geracao
+            for chave, (df, _) in self.intervalos.items():
+                if chave[0] <= inicio and fim <= chave[1]:
+                    self.intervalos.move_to_end(chave)
+                    self.hits += 1
+                    return self._slice(df, inicio, fim)
+
+            # Intervalos que se sobrepõem ou são adjacentes ao pedido são fundidos nele
+            vizinhos = sorted(
+                (chave, df) for chave, (df, _) in self.intervalos.items()
+                if chave[0] <= fim + timedelta(days=1) and chave[1] >= inicio - timedelta(days=1)
+            )
+            if vizinhos:
+                self.parciais += 1
+            else:
+                self.misses += 1
+
+        novo_inicio = min([inicio] + [chave[0] for chave, _ in vizinhos])
+        novo_fim = max([fim] + [chave[1] for chave, _ in vizinhos])
+
+        # Consulta o banco fora do lock, apenas nos buracos entre os intervalos já carregados.
+        # Se alguma busca falhar, a exceção sobe antes do armazenamento e nada é guardado.
+        partes = [df for _, df in vizinhos]
+        cursor = novo_inicio
+        for chave, _ in vizinhos:
+            if cursor < chave[0]:
+                partes.append(fetch(cursor.isoformat(), (chave[0] - timedelta(days=1)).isoformat()))
+            cursor = max(cursor, chave[1] + timedelta(days=1))
+        if cursor <= novo_fim:
+            partes.append(fetch(cursor.isoformat(), novo_fim.isoformat()))
+
+        partes = [p for p in partes if not p.empty]
+        if partes:
+            df_novo = pd.concat(partes, ignore_index=True).sort_values(by="Data", ascending=False, kind="stable")
+        else:
+            df_novo = pd.DataFrame(columns=COLUNAS_TRANSACOES)
+
+        with self.lock:
+            if self.geracao != geracao or self._vizinhos_mudaram(novo_inicio, novo_fim, vizinhos):
+                return self._slice(df_novo, inicio, fim)
+            for chave, _ in vizinhos:
+                self.intervalos.pop(chave, None)
+            tamanho = int(df_novo.memory_usage(deep=True).sum())
+            if tamanho <= self.max_bytes:
+                self.intervalos[(novo_inicio, novo_fim)] = (df_novo, tamanho)
+                self._evict()
+        return self._slice(df_novo, inicio, fim)
+
+    def _vizinhos_mudaram(self, inicio, fim, vizinhos):
+        """Há intervalo guardado encostando em [inicio, fim] que não estava em `vizinhos`?"""
+        conhecidos = {chave for chave, _ in vizinhos}
+        return any(
+            chave not in conhecidos
+            for chave in self.intervalos
+            if chave[0] <= fim + timedelta(days=1) and chave[1] >= inicio - timedelta(days=1)
+        )
+
+    def _evict(self):
+        while len(self.intervalos) > 1 and self.memory_usage() > self.max_bytes:
+            self.intervalos.popitem(last=False)
+            self.evictions += 1
+
+    def _slice(self, df, inicio, fim):
+        if df.empty:
+            return pd.DataFrame(columns=COLUNAS_TRANSACOES)
+        mask = (df['Data'] >= pd.Timestamp(inicio)) & (df['Data'] <= pd.Timestamp(fim))
+        return df[mask].reset_index(drop=True)
+
+    def memory_usage(self):
+        return sum(tamanho for _, tamanho in self.intervalos.values())
+
+    def clear(self):
+        with self.lock:
+            self.intervalos.clear()
+            self.geracao += 1
+
+    def stats(self):
+        with self.lock:
+            pedidos = self.hits + self.parciais + self.misses
+            return {
+                "Intervalos": len(self.intervalos),
+                "Memória (MB)": round(self.memory_usage() / 1024 ** 2, 2),
+                "Limite (MB)": round(self.max_bytes / 1024 ** 2, 2),
+                "Acertos": self.hits,
+                "Acertos parciais": self.parciais,
+                "Faltas": self.misses,
+                "Remoções (LRU)": self.evictions,
+                "Taxa de acerto": round(self.hits / pedidos, 3) if pedidos else 0.0,
+                "Faixas": [f"{i.isoformat()} a {f.isoformat()}" for i, f in self.intervalos],
+            }
+
+@st.cache_resource
+def get_transaction_cache():
+    return TransactionRangeCache(int(CACHE_TRANSACOES_MAX_MB * 1024 * 1024))
+
+def clear_transaction_caches():
+    st.cache_data.clear()
+    get_transaction_cache().clear()
+
+# --- Detector de Anomalias ---
+@st.cache_resource
+def get_anomaly_detector():
+    return IncrementalAnomalyDetector()
+
+def load_transactions_since(ultimo_id):
+    """Transações com id maior que `ultimo_id` (as que o detector ainda não viu)."""
+    if DB_TYPE == "sql":
+        df = conn.query("SELECT * FROM transacoes WHERE id > :id ORDER BY id", params=dict(id=ultimo_id), ttl=0)
+    else:
+        df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(
+            SQL_LOAD_TRANSACTIONS_SINCE, db_conn, params=(ultimo_id,)
+        ))
+    if df.empty or 'Data' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_TRANSACOES)
+    return df
+
+def refresh_anomalies():
+    """Atualiza o detector só com as transações novas (o lote completo roda apenas na primeira vez ou após reset)."""
+    detector = get_anomaly_detector()
+    with detector.lock:
+        novas = load_transactions_since(detector.ultimo_id)
+        if not detector.ajustado:
+            detector.fit(novas)
+        else:
+            detector.update(novas)
+        return detector.anomalias.copy(), detector.anomalias_mensais.copy()
+
 # --- Funções CRUD (Transações) ---
-def save_transaction(data, categoria, descricao, valor, cartao):
+class DuplicateTransactionError(Exception):
+    pass
+
+def save_transaction(data, categoria, descricao, valor, cartao, duplicados="sinalizar"):
+    """Salva a transação e devolve o id de uma transação idêntica já existente (ou None).
+
+    A checagem é uma busca pelo fingerprint na coluna indexada. Com
+    duplicados="rejeitar" a transação não é salva e DuplicateTransactionError é
+    levantado; com "sinalizar" ela é salva e o id da existente é devolvido; com
+    "permitir" não há checagem.
+    """
     # Esta função agora vai gerar um erro se a conexão falhar,
     # que será capturado pelo try/except no formulário.
+    fingerprint = transaction_fingerprint(data, descricao, valor, cartao)
     if DB_TYPE == "sql":
         with conn.session as s:
-            s.execute(
-                text("INSERT INTO transacoes (Data, Categoria, Descricao, Valor, Cartao) VALUES (:data, :cat, :desc, :val, :cart)"),
-                params=dict(data=data, cat=categoria, desc=descricao, val=valor, cart=cartao)
-            )
+            existente = None
+            if duplicados != "permitir":
+                # Serializa sessões salvando o mesmo fingerprint até o commit (ex: clique duplo); o lock é
+                # liberado sozinho no fim da transação, como o BEGIN IMMEDIATE do SQLite
+                s.execute(text("SELECT pg_advisory_xact_lock(hashtext(:fp))"), params=dict(fp=fingerprint))
+                existente = s.execute(
+                    text("SELECT id FROM transacoes WHERE Fingerprint = :fp LIMIT 1"), params=dict(fp=fingerprint)
+                ).scalar()
+            if existente is None or duplicados != "rejeitar":
+                s.execute(
+                    text("""INSERT INTO transacoes (Data, Categoria, Descricao, Valor, Cartao, Fingerprint)
+                           VALUES (:data, :cat, :desc, :val, :cart, :fp)"""),
+                    params=dict(data=data, cat=categoria, desc=descricao, val=valor, cart=cartao, fp=fingerprint)
+                )
             s.commit()
     else:
-        db_conn = get_db_connection_sqlite()
-        cursor = db_conn.cursor()
-        cursor.execute(
-            "INSERT INTO transacoes (Data, Categoria, Descricao, Valor, Cartao) VALUES (?, ?, ?, ?, ?)",
-            (data, categoria, descricao, valor, cartao)
-        )
-        db_conn.commit()
-        db_conn.close()
-    st.cache_data.clear()
+        def inserir(db_conn):
+            # BEGIN IMMEDIATE: a checagem e o INSERT ficam na mesma transação de escrita (ex: clique duplo)
+            db_conn.execute("BEGIN IMMEDIATE")
+            linha = None
+            if duplicados != "permitir":
+                linha = db_conn.execute(SQL_FIND_FINGERPRINT, (fingerprint,)).fetchone()
+            if linha is None or duplicados != "rejeitar":
+                db_conn.execute(
+                    SQL_SAVE_TRANSACTION, (data, categoria, descricao, valor, cartao, fingerprint)
+                )
+            return linha[0] if linha else None
+        existente = run_sqlite_with_retry(inserir)
+
+    if existente is not None and duplicados == "rejeitar":
+        raise DuplicateTransactionError(f"Transação idêntica já cadastrada (ID {existente}). Nada foi salvo.")
+    clear_transaction_caches()
+    return existente
 
-@st.cache_data 
 def load_transactions(start_date, end_date):
-    df = pd.DataFrame(columns=COLUNAS_TRANSACOES)
     try:
-        if DB_TYPE == "sql":
-            query = "SELECT * FROM transacoes WHERE Data BETWEEN :start AND :end ORDER BY Data DESC"
-            df = conn.query(query, params=dict(start=start_date, end=end_date))
-        else:
-            query_sqlite = "SELECT * FROM transacoes WHERE Data BETWEEN ? AND ? ORDER BY Data DESC"
-            db_conn = get_db_connection_sqlite()
-            df = pd.read_sql_query(query_sqlite, db_conn, params=(start_date, end_date))
-            db_conn.close()
+        return get_transaction_cache().get(start_date, end_date, fetch_transactions)
     except Exception as e:
         # Se a tabela não existir (ex: primeiro deploy), não mostra erro, apenas retorna vazio
         return pd.DataFrame(columns=COLUNAS_TRANSACOES)
-    
+
+def fetch_transactions(start_date, end_date):
+    """Busca usada pelo TransactionRangeCache. Erros sobem: um trecho que falhou não pode ser guardado como vazio."""
+    if DB_TYPE == "sql":
+        query = "SELECT * FROM transacoes WHERE Data BETWEEN :start AND :end ORDER BY Data DESC"
+        df = conn.query(query, params=dict(start=start_date, end=end_date), ttl=0)  # o cache por intervalo fica em TransactionRangeCache
+    else:
+        df = run_sqlite_with_retry(
+            lambda db_conn: pd.read_sql_query(SQL_LOAD_TRANSACTIONS, db_conn, params=(start_date, end_date))
+        )
+
     if df.empty or 'Data' not in df.columns:
         return pd.DataFrame(columns=COLUNAS_TRANSACOES)
 
@@ -136,13 +385,11 @@ def load_transactions(start_date, end_date):
 def load_all_transactions():
     df = pd.DataFrame(columns=COLUNAS_TRANSACOES)
     try:
-        query = "SELECT * FROM transacoes ORDER BY Data DESC"
+        query = SQL_LOAD_ALL_TRANSACTIONS
         if DB_TYPE == "sql":
             df = conn.query(query)
         else:
-            db_conn = get_db_connection_sqlite()
-            df = pd.read_sql_query(query, db_conn)
-            db_conn.close()
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
     except Exception as e:
         return pd.DataFrame(columns=COLUNAS_TRANSACOES)
 
@@ -158,35 +405,44 @@ def delete_transaction(id):
             s.execute(text("DELETE FROM transacoes WHERE id = :id"), params=dict(id=id))
             s.commit()
     else:
-        db_conn = get_db_connection_sqlite()
-        cursor = db_conn.cursor()
-        cursor.execute("DELETE FROM transacoes WHERE id = ?", (id,))
-        db_conn.commit()
-        db_conn.close()
-    st.cache_data.clear()
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute(SQL_DELETE_TRANSACTION, (id,)))
+    clear_transaction_caches()
+    get_anomaly_detector().reset()  # Edição/exclusão muda o histórico: o próximo acesso refaz o lote
 
 def update_transaction(id, data, categoria, descricao, valor, cartao):
     if DB_TYPE == "sql":
         with conn.session as s:
             s.execute(
                 text("""UPDATE transacoes 
-                       SET Data = :data, Categoria = :cat, Descricao = :desc, Valor = :val, Cartao = :cart
+                       SET Data = :data, Categoria = :cat, Descricao = :desc, Valor = :val, Cartao = :cart, Fingerprint = :fp
                        WHERE id = :id"""),
-                params=dict(data=data, cat=categoria, desc=descricao, val=valor, cart=cartao, id=id)
+                params=dict(data=data, cat=categoria, desc=descricao, val=valor, cart=cartao, id=id,
+                            fp=transaction_fingerprint(data, descricao, valor, cartao))
             )
             s.commit()
     else:
-        db_conn = get_db_connection_sqlite()
-        cursor = db_conn.cursor()
-        cursor.execute(
-            """UPDATE transacoes 
-               SET Data = ?, Categoria = ?, Descricao = ?, Valor = ?, Cartao = ?
-               WHERE id = ?""",
-            (data, categoria, descricao, valor, cartao, id)
-        )
-        db_conn.commit()
-        db_conn.close()
-    st.cache_data.clear()
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute(
+            SQL_UPDATE_TRANSACTION,
+            (data, categoria, descricao, valor, cartao, transaction_fingerprint(data, descricao, valor, cartao), id)
+        ))
+    clear_transaction_caches()
+    get_anomaly_detector().reset()  # Edição/exclusão muda o histórico: o próximo acesso refaz o lote
+
+@st.cache_data
+def load_near_duplicates(janela_dias, similaridade_minima):
+    """Quase-duplicatas agrupadas por prefixo do fingerprint e janela de datas (sem comparar todos os pares)."""
+    try:
+        query = SQL_LOAD_NEAR_DUPLICATES
+        if DB_TYPE == "sql":
+            df = conn.query(query)
+        else:
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_DUPLICATAS)
+
+    if df.empty or 'Fingerprint' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_DUPLICATAS)
+    return find_near_duplicates(df, janela_dias, similaridade_minima)
 
 # --- Funções CRUD (Faturas) ---
 def save_fatura(cartao, mes_ano, valor):
@@ -198,27 +454,21 @@ def save_fatura(cartao, mes_ano, valor):
             )
             s.commit()
     else:
-        db_conn = get_db_connection_sqlite()
-        cursor = db_conn.cursor()
-        cursor.execute(
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute(
             "INSERT INTO faturas (Cartao, MesAno, ValorFatura) VALUES (?, ?, ?)",
             (cartao, mes_ano, valor)
-        )
-        db_conn.commit()
-        db_conn.close()
+        ))
     st.cache_data.clear()
 
 @st.cache_data
 def load_faturas():
     df = pd.DataFrame(columns=COLUNAS_FATURAS)
     try:
-        query = "SELECT * FROM faturas ORDER BY MesAno"
+        query = SQL_LOAD_FATURAS
         if DB_TYPE == "sql":
             df = conn.query(query)
         else:
-            db_conn = get_db_connection_sqlite()
-            df = pd.read_sql_query(query, db_conn)
-            db_conn.close()
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
     except Exception as e:
         return pd.DataFrame(columns=COLUNAS_FATURAS)
     
@@ -227,39 +477,110 @@ def load_faturas():
     return df
 
 # --- Funções CRUD (Orçamentos) ---
-def save_budget(categoria, valor):
+# Orçamentos são versionados por mês: o valor salvo para 'YYYY-MM' vale desse mês em diante, até a próxima
+# versão da mesma categoria. A tabela antiga `orcamentos` continua valendo como base para meses sem versão.
+def save_budget(categoria, valor, mes_ano):
     if DB_TYPE == "sql":
         with conn.session as s:
             s.execute(
                 text("""
-                INSERT INTO orcamentos (Categoria, Valor) VALUES (:cat, :val)
-                ON CONFLICT (Categoria) DO UPDATE SET Valor = :val
+                INSERT INTO orcamentos_mensais (Categoria, MesAno, Valor) VALUES (:cat, :mes, :val)
+                ON CONFLICT (Categoria, MesAno) DO UPDATE SET Valor = :val
                 """),
-                params=dict(cat=categoria, val=valor)
+                params=dict(cat=categoria, mes=mes_ano, val=valor)
             )
             s.commit()
     else:
-        db_conn = get_db_connection_sqlite()
-        cursor = db_conn.cursor()
-        cursor.execute(
-            "INSERT OR REPLACE INTO orcamentos (Categoria, Valor) VALUES (?, ?)",
-            (categoria, valor)
-        )
-        db_conn.commit()
-        db_conn.close()
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute(
+            "INSERT OR REPLACE INTO orcamentos_mensais (Categoria, MesAno, Valor) VALUES (?, ?, ?)",
+            (categoria, mes_ano, valor)
+        ))
     st.cache_data.clear()
 
+@st.cache_data
+def load_monthly_budgets():
+    df = pd.DataFrame(columns=COLUNAS_ORCAMENTOS_MENSAIS)
+    try:
+        query = SQL_LOAD_MONTHLY_BUDGETS
+        if DB_TYPE == "sql":
+            df = conn.query(query)
+        else:
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_ORCAMENTOS_MENSAIS)
+
+    if df.empty or 'MesAno' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_ORCAMENTOS_MENSAIS)
+    return df
+
+@st.cache_data
+def load_monthly_spending(start_date, end_date):
+    """Gasto por Categoria x MesAno no período, agregado no banco em uma única consulta."""
+    df = pd.DataFrame(columns=COLUNAS_GASTOS_MENSAIS)
+    try:
+        if DB_TYPE == "sql":
+            query = """SELECT Categoria, to_char(Data, 'YYYY-MM') AS MesAno, SUM(-Valor) AS Gasto FROM transacoes
+                       WHERE Valor < 0 AND Categoria != 'Fatura Cartão' AND Data BETWEEN :start AND :end
+                       GROUP BY Categoria, to_char(Data, 'YYYY-MM')"""
+            df = conn.query(query, params=dict(start=start_date, end=end_date))
+        else:
+            df = run_sqlite_with_retry(
+                lambda db_conn: pd.read_sql_query(SQL_LOAD_MONTHLY_SPENDING, db_conn, params=(start_date, end_date))
+            )
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_GASTOS_MENSAIS)
+
+    if df.empty or 'MesAno' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_GASTOS_MENSAIS)
+    return df
+
+def budget_history(df_base, df_versoes, df_gastos, meses):
+    """Orçado x gasto x variação para toda combinação Categoria x mês de `meses` ('YYYY-MM').
+
+    O orçado de cada célula é a última versão com MesAno <= mês (merge_asof por
+    categoria) ou, sem versão, o valor base de `orcamentos`. Tudo é feito com
+    operações vetorizadas do pandas, sem laço por categoria ou por mês.
+    """
+    categorias = sorted(set(df_base['Categoria']) | set(df_versoes['Categoria']))
+    if not categorias or not meses:
+        return pd.DataFrame(columns=["Categoria", "MesAno", "Orcado", "Gasto", "Variacao", "Uso"])
+
+    def mes_ordinal(serie):
+        return pd.PeriodIndex(serie, freq='M').asi8
+
+    grade = pd.MultiIndex.from_product([categorias, meses], names=["Categoria", "MesAno"]).to_frame(index=False)
+    grade['Ordinal'] = mes_ordinal(grade['MesAno'])
+
+    if not df_versoes.empty:
+        versoes = df_versoes[['Categoria', 'MesAno', 'Valor']].assign(Ordinal=mes_ordinal(df_versoes['MesAno']))
+        grade = pd.merge_asof(
+            grade.sort_values('Ordinal'),
+            versoes[['Categoria', 'Ordinal', 'Valor']].sort_values('Ordinal'),
+            on='Ordinal', by='Categoria', direction='backward'
+        )
+    else:
+        grade['Valor'] = np.nan
+
+    base = df_base.set_index('Categoria')['Valor']
+    grade['Orcado'] = grade['Valor'].fillna(grade['Categoria'].map(base))
+    grade = grade.merge(df_gastos, on=['Categoria', 'MesAno'], how='left')
+    grade['Gasto'] = grade['Gasto'].fillna(0.0)
+    grade['Variacao'] = grade['Orcado'] - grade['Gasto']
+    grade['Uso'] = grade['Gasto'] / grade['Orcado']
+
+    return grade[grade['Orcado'].notna()][
+        ["Categoria", "MesAno", "Orcado", "Gasto", "Variacao", "Uso"]
+    ].sort_values(["Categoria", "MesAno"]).reset_index(drop=True)
+
 @st.cache_data
 def load_budgets():
     df = pd.DataFrame(columns=COLUNAS_ORCAMENTOS)
     try:
-        query = "SELECT * FROM orcamentos"
+        query = SQL_LOAD_BUDGETS
         if DB_TYPE == "sql":
             df = conn.query(query)
         else:
-            db_conn = get_db_connection_sqlite()
-            df = pd.read_sql_query(query, db_conn)
-            db_conn.close()
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
     except Exception as e:
         return pd.DataFrame(columns=COLUNAS_ORCAMENTOS)
 
@@ -267,6 +588,348 @@ def load_budgets():
         return pd.DataFrame(columns=COLUNAS_ORCAMENTOS)
     return df
 
+# --- Funções CRUD (Dias de Fechamento) ---
+def save_closing_day(cartao, dia):
+    if DB_TYPE == "sql":
+        with conn.session as s:
+            s.execute(
+                text("""
+                INSERT INTO cartoes_fechamento (Cartao, DiaFechamento) VALUES (:cart, :dia)
+                ON CONFLICT (Cartao) DO UPDATE SET DiaFechamento = :dia
+                """),
+                params=dict(cart=cartao, dia=dia)
+            )
+            s.commit()
+    else:
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute(
+            "INSERT OR REPLACE INTO cartoes_fechamento (Cartao, DiaFechamento) VALUES (?, ?)",
+            (cartao, dia)
+        ))
+    st.cache_data.clear()
+
+@st.cache_data
+def load_closing_days():
+    df = pd.DataFrame(columns=COLUNAS_FECHAMENTO)
+    try:
+        query = SQL_LOAD_CLOSING_DAYS
+        if DB_TYPE == "sql":
+            df = conn.query(query)
+        else:
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_FECHAMENTO)
+
+    if df.empty or 'Cartao' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_FECHAMENTO)
+    return df
+
+# --- Conciliação de Faturas ---
+@st.cache_data
+def load_invoice_reconciliation():
+    """Fatura declarada x soma dos gastos no cartão, por ciclo de fatura, em uma única consulta agregada."""
+    df = pd.DataFrame(columns=COLUNAS_CONCILIACAO)
+    try:
+        if DB_TYPE == "sql":
+            nomes = [f"c{i}" for i in range(len(CARTOES_CREDITO))]
+            query = SQL_CONCILIACAO.format(mes_fatura=MES_FATURA_SQL, cartoes=", ".join(f":{n}" for n in nomes))
+            df = conn.query(query, params=dict(zip(nomes, CARTOES_CREDITO)))
+        else:
+            query_sqlite = sqlite_reconciliation_query(CARTOES_CREDITO)
+            df = run_sqlite_with_retry(
+                lambda db_conn: pd.read_sql_query(query_sqlite, db_conn, params=tuple(CARTOES_CREDITO))
+            )
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_CONCILIACAO)
+
+    if df.empty or 'MesAno' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_CONCILIACAO)
+    return df
+
+def billing_cycle(mes_ano, dia_fechamento):
+    """Primeiro e último dia do ciclo da fatura `mes_ano` ('YYYY-MM') para o dia de fechamento dado."""
+    ano, mes = map(int, mes_ano.split("-"))
+    fim = date(ano, mes, min(dia_fechamento, pd.Period(mes_ano, 'M').days_in_month))
+    mes_anterior = pd.Period(mes_ano, 'M') - 1
+    inicio = date(
+        mes_anterior.year, mes_anterior.month, min(dia_fechamento, mes_anterior.days_in_month)
+    ) + timedelta(days=1)
+    return inicio, fim
+
+@st.cache_data
+def load_cycle_transactions(cartao, inicio, fim, pagina):
+    """Uma página (LINHAS_POR_PAGINA linhas) dos gastos de um cartão dentro de um ciclo de fatura."""
+    df = pd.DataFrame(columns=COLUNAS_TRANSACOES)
+    offset = pagina * LINHAS_POR_PAGINA
+    try:
+        if DB_TYPE == "sql":
+            query = """SELECT * FROM transacoes
+                       WHERE Cartao = :cart AND Data BETWEEN :start AND :end AND Valor < 0 AND Categoria != 'Fatura Cartão'
+                       ORDER BY Data, id LIMIT :lim OFFSET :off"""
+            df = conn.query(query, params=dict(cart=cartao, start=inicio, end=fim, lim=LINHAS_POR_PAGINA, off=offset))
+        else:
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(
+                SQL_LOAD_CYCLE_TRANSACTIONS, db_conn, params=(cartao, inicio, fim, LINHAS_POR_PAGINA, offset)
+            ))
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_TRANSACOES)
+
+    if df.empty or 'Data' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_TRANSACOES)
+
+    df['Data'] = pd.to_datetime(df['Data'])
+    return df
+
+# --- Funções CRUD (Recorrências e Parcelamentos) ---
+def save_recurring_rule(descricao, categoria, valor, cartao, inicio, fim):
+    if DB_TYPE == "sql":
+        with conn.session as s:
+            s.execute(
+                text("""INSERT INTO recorrencias (Descricao, Categoria, Valor, Cartao, Inicio, Fim)
+                       VALUES (:desc, :cat, :val, :cart, :ini, :fim)"""),
+                params=dict(desc=descricao, cat=categoria, val=valor, cart=cartao, ini=inicio, fim=fim)
+            )
+            s.commit()
+    else:
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute(
+            "INSERT INTO recorrencias (Descricao, Categoria, Valor, Cartao, Inicio, Fim) VALUES (?, ?, ?, ?, ?, ?)",
+            (descricao, categoria, valor, cartao, inicio, fim)
+        ))
+    st.cache_data.clear()
+
+def delete_recurring_rule(id):
+    if DB_TYPE == "sql":
+        with conn.session as s:
+            s.execute(text("DELETE FROM recorrencias WHERE id = :id"), params=dict(id=id))
+            s.commit()
+    else:
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute("DELETE FROM recorrencias WHERE id = ?", (id,)))
+    st.cache_data.clear()
+
+@st.cache_data
+def load_recurring_rules():
+    df = pd.DataFrame(columns=COLUNAS_RECORRENCIAS)
+    try:
+        query = SQL_LOAD_RECURRING_RULES
+        if DB_TYPE == "sql":
+            df = conn.query(query)
+        else:
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_RECORRENCIAS)
+
+    if df.empty or 'Inicio' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_RECORRENCIAS)
+    return df
+
+def save_installment(descricao, categoria, valor_total, num_parcelas, data_compra, cartao):
+    if DB_TYPE == "sql":
+        with conn.session as s:
+            s.execute(
+                text("""INSERT INTO parcelamentos (Descricao, Categoria, ValorTotal, NumParcelas, DataCompra, Cartao)
+                       VALUES (:desc, :cat, :val, :n, :data, :cart)"""),
+                params=dict(desc=descricao, cat=categoria, val=valor_total, n=num_parcelas, data=data_compra, cart=cartao)
+            )
+            s.commit()
+    else:
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute(
+            """INSERT INTO parcelamentos (Descricao, Categoria, ValorTotal, NumParcelas, DataCompra, Cartao)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (descricao, categoria, valor_total, num_parcelas, data_compra, cartao)
+        ))
+    st.cache_data.clear()
+
+def delete_installment(id):
+    if DB_TYPE == "sql":
+        with conn.session as s:
+            s.execute(text("DELETE FROM parcelamentos WHERE id = :id"), params=dict(id=id))
+            s.commit()
+    else:
+        run_sqlite_with_retry(lambda db_conn: db_conn.execute("DELETE FROM parcelamentos WHERE id = ?", (id,)))
+    st.cache_data.clear()
+
+@st.cache_data
+def load_installments():
+    df = pd.DataFrame(columns=COLUNAS_PARCELAMENTOS)
+    try:
+        query = SQL_LOAD_INSTALLMENTS
+        if DB_TYPE == "sql":
+            df = conn.query(query)
+        else:
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_PARCELAMENTOS)
+
+    if df.empty or 'DataCompra' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_PARCELAMENTOS)
+    return df
+
+@st.cache_data
+def load_current_balance(ate_data):
+    """Saldo (receitas - despesas, sem 'Fatura Cartão') de todas as transações até `ate_data`."""
+    try:
+        if DB_TYPE == "sql":
+            query = "SELECT SUM(Valor) AS Saldo FROM transacoes WHERE Categoria != 'Fatura Cartão' AND Data <= :ate"
+            df = conn.query(query, params=dict(ate=ate_data))
+        else:
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(SQL_LOAD_CURRENT_BALANCE, db_conn, params=(ate_data,)))
+    except Exception as e:
+        return 0.0
+
+    if df.empty or pd.isna(df.iloc[0, 0]):
+        return 0.0
+    return float(df.iloc[0, 0])
+
+# --- Projeção de Fluxo de Caixa ---
+def forecast_cash_flow(df_regras, df_parcelas, inicio_mes, n_meses):
+    """Expande recorrências e parcelamentos sobre `n_meses` a partir de `inicio_mes` ('YYYY-MM').
+
+    Tudo é feito com aritmética de datas do NumPy (datetime64[M]) sobre matrizes
+    regra x mês, sem laço por regra ou por parcela. Valores de recorrências
+    seguem o sinal da transação (receita > 0, despesa < 0); cada parcela vale
+    ValorTotal / NumParcelas e a primeira cai no mês da compra.
+
+    Retorna (df_mensal, df_faturas): receitas/despesas/líquido por mês e o valor
+    projetado de fatura por mês para cada cartão de CARTOES_CREDITO.
+    """
+    meses = np.datetime64(inicio_mes, 'M') + np.arange(n_meses)
+    receitas = np.zeros(n_meses)
+    despesas = np.zeros(n_meses)
+    faturas = np.zeros((len(CARTOES_CREDITO), n_meses))
+
+    if not df_regras.empty:
+        valor = df_regras['Valor'].to_numpy(dtype=float)
+        inicio = pd.to_datetime(df_regras['Inicio']).to_numpy().astype('datetime64[M]')
+        fim = pd.to_datetime(df_regras['Fim']).to_numpy().astype('datetime64[M]')
+        fim = np.where(np.isnat(fim), meses[-1], fim)  # Sem data de término: vale até o fim do horizonte
+
+        ativo = (meses >= inicio[:, None]) & (meses <= fim[:, None])
+        grade = np.where(ativo, valor[:, None], 0.0)  # (regras, meses)
+        receitas += grade.clip(min=0).sum(axis=0)
+        despesas += grade.clip(max=0).sum(axis=0)
+
+        cartao = pd.Index(CARTOES_CREDITO).get_indexer(df_regras['Cartao'])
+        por_cartao = (cartao[None, :] == np.arange(len(CARTOES_CREDITO))[:, None]).astype(float)
+        faturas += por_cartao @ (-grade.clip(max=0))
+
+    if not df_parcelas.empty:
+        n_parcelas = df_parcelas['NumParcelas'].to_numpy(dtype=np.int64)
+        parcela = df_parcelas['ValorTotal'].to_numpy(dtype=float) / n_parcelas
+        compra = pd.to_datetime(df_parcelas['DataCompra']).to_numpy().astype('datetime64[M]')
+
+        k = np.arange(n_parcelas.max())
+        pos = (compra - meses[0]).astype(np.int64)[:, None] + k  # (parcelamentos, parcelas): índice no horizonte
+        valida = (k < n_parcelas[:, None]) & (pos >= 0) & (pos < n_meses)
+
+        pos_validas = pos[valida]
+        pesos = np.broadcast_to(parcela[:, None], pos.shape)[valida]
+        despesas -= np.bincount(pos_validas, weights=pesos, minlength=n_meses)
+
+        cartao = np.broadcast_to(
+            pd.Index(CARTOES_CREDITO).get_indexer(df_parcelas['Cartao'])[:, None], pos.shape
+        )[valida]
+        credito = cartao >= 0
+        faturas += np.bincount(
+            cartao[credito].astype(np.int64) * n_meses + pos_validas[credito],
+            weights=pesos[credito],
+            minlength=len(CARTOES_CREDITO) * n_meses
+        ).reshape(len(CARTOES_CREDITO), n_meses)
+
+    mes_ano = meses.astype(str)
+    df_mensal = pd.DataFrame({
+        'MesAno': mes_ano, 'Receita': receitas, 'Despesa': -despesas, 'Liquido': receitas + despesas
+    })
+    df_faturas = pd.DataFrame({
+        'MesAno': np.tile(mes_ano, len(CARTOES_CREDITO)),
+        'Cartao': np.repeat(CARTOES_CREDITO, n_meses),
+        'ValorFatura': faturas.ravel()
+    })
+    return df_mensal, df_faturas[df_faturas['ValorFatura'] > 0].reset_index(drop=True)
+
+# --- Séries Temporais (Saldo Diário) ---
+@st.cache_data
+def load_date_bounds():
+    """Primeira e última data com transações (ou None, None se não houver)."""
+    try:
+        query = SQL_LOAD_DATE_BOUNDS
+        if DB_TYPE == "sql":
+            df = conn.query(query)
+        else:
+            df = run_sqlite_with_retry(lambda db_conn: pd.read_sql_query(query, db_conn))
+    except Exception as e:
+        return None, None
+
+    if df.empty or pd.isna(df.iloc[0, 0]):
+        return None, None
+    return pd.to_datetime(df.iloc[0, 0]).date(), pd.to_datetime(df.iloc[0, 1]).date()
+
+@st.cache_data
+def load_daily_balance(start_date, end_date):
+    """Fluxo diário e saldo acumulado no período.
+
+    O saldo acumulado é calculado no banco com uma window function sobre todo o
+    histórico e só depois filtrado, então o saldo do primeiro dia do período já
+    inclui tudo o que veio antes. 'Fatura Cartão' fica de fora, como nos KPIs.
+    """
+    df = pd.DataFrame(columns=COLUNAS_SALDO_DIARIO)
+    try:
+        if DB_TYPE == "sql":
+            query = """
+            SELECT Data, Fluxo, Saldo FROM (
+                SELECT Data, SUM(Valor) AS Fluxo, SUM(SUM(Valor)) OVER (ORDER BY Data) AS Saldo
+                FROM transacoes WHERE Categoria != 'Fatura Cartão' GROUP BY Data
+            ) diario WHERE Data BETWEEN :start AND :end ORDER BY Data
+            """
+            df = conn.query(query, params=dict(start=start_date, end=end_date))
+        else:
+            df = run_sqlite_with_retry(
+                lambda db_conn: pd.read_sql_query(SQL_LOAD_DAILY_BALANCE, db_conn, params=(start_date, end_date))
+            )
+    except Exception as e:
+        return pd.DataFrame(columns=COLUNAS_SALDO_DIARIO)
+
+    if df.empty or 'Data' not in df.columns:
+        return pd.DataFrame(columns=COLUNAS_SALDO_DIARIO)
+
+    df['Data'] = pd.to_datetime(df['Data'])
+    return df
+
+def downsample_lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: devolve os índices de `n_out` pontos que preservam o formato da série.
+
+    O primeiro e o último ponto são mantidos; de cada bucket intermediário fica o
+    ponto que forma o maior triângulo com o ponto escolhido antes e a média do
+    próximo bucket, o que preserva picos e vales que uma média apagaria.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    bordas = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+
+    a = 0
+    for i in range(n_out - 2):
+        ini, fim = bordas[i], bordas[i + 1]
+        prox_fim = bordas[i + 2] if i + 2 < len(bordas) else n
+        media_x = x[fim:prox_fim].mean()
+        media_y = y[fim:prox_fim].mean()
+        areas = np.abs(
+            (x[a] - media_x) * (y[ini:fim] - y[a]) - (x[a] - x[ini:fim]) * (media_y - y[a])
+        )
+        a = ini + int(areas.argmax())
+        idx[i + 1] = a
+    return idx
+
+def downsample_series(df, x_col, y_col, n_out=LARGURA_GRAFICO_PX):
+    """Aplica LTTB em um DataFrame ordenado por `x_col` (datas viram número de dias)."""
+    if len(df) <= n_out:
+        return df
+    x = df[x_col].values.astype('datetime64[D]').astype(np.int64)
+    return df.iloc[downsample_lttb(x, df[y_col].values, n_out)]
+
 # --- Inicializa o DB ---
 init_db()
 
@@ -331,6 +994,13 @@ st.sidebar.title("Controle Financeiro PRO")
 st.sidebar.markdown("---")
 st.sidebar.header("Navegação 🧭")
 st.sidebar.info("Use as abas no topo da página para navegar entre os dashboards.")
+st.sidebar.markdown("---")
+politica_duplicados = st.sidebar.selectbox(
+    "Ao salvar uma transação idêntica a outra já cadastrada:",
+    POLITICAS_DUPLICADOS,
+    format_func={"sinalizar": "Salvar e avisar", "rejeitar": "Não salvar", "permitir": "Salvar sem checar"}.get,
+    key="politica_duplicados"
+)
 
 
 # =====================================================================
@@ -368,15 +1038,20 @@ with tab_dash:
                 if submit_receita:
                     # --- CORREÇÃO: Adicionado Try/Except ---
                     try:
-                        save_transaction(
+                        duplicata = save_transaction(
                             data_receita.strftime("%Y-%m-%d"), 
                             categoria_receita, 
                             descricao_receita, 
                             valor_receita, 
-                            "N/A"
+                            "N/A",
+                            duplicados=politica_duplicados
                         )
+                        if duplicata is not None:
+                            st.session_state["aviso_duplicata"] = duplicata
                         st.success("Receita salva com sucesso!")
                         st.rerun()
+                    except DuplicateTransactionError as e:
+                        st.warning(str(e))
                     except Exception as e:
                         st.error(f"Erro ao salvar: {e}")
                         st.error("Verifique os 'Segredos' (Secrets) da sua conexão no Streamlit Cloud.")
@@ -394,20 +1069,32 @@ with tab_dash:
                 if submit_despesa:
                     # --- CORREÇÃO: Adicionado Try/Except ---
                     try:
-                        save_transaction(
+                        duplicata = save_transaction(
                             data_despesa.strftime("%Y-%m-%d"), 
                             categoria_despesa, 
                             descricao_despesa, 
                             valor_despesa * -1,
-                            cartao_despesa
+                            cartao_despesa,
+                            duplicados=politica_duplicados
                         )
+                        if duplicata is not None:
+                            st.session_state["aviso_duplicata"] = duplicata
                         st.success("Despesa salva com sucesso!")
                         st.rerun()
+                    except DuplicateTransactionError as e:
+                        st.warning(str(e))
                     except Exception as e:
                         st.error(f"Erro ao salvar: {e}")
                         st.error("Verifique os 'Segredos' (Secrets) da sua conexão no Streamlit Cloud.")
 
     
+    # Aviso de duplicata sobrevive ao st.rerun() do formulário
+    if "aviso_duplicata" in st.session_state:
+        st.warning(
+            f"A transação salva é idêntica à de ID {st.session_state.pop('aviso_duplicata')} "
+            "(mesma data, valor, cartão e descrição). Exclua uma delas se foi lançada duas vezes."
+        )
+
     # --- 1. FILTROS DE DATA ---
     with st.container(border=True):
         st.header("Filtros 📅")
@@ -504,48 +1191,278 @@ with tab_dash:
 
     st.markdown("<br/>", unsafe_allow_html=True)
 
+    # --- 3.1 GASTOS FORA DO PADRÃO ---
+    with st.container(border=True):
+        st.header("Gastos Fora do Padrão 🚨")
+        try:
+            df_anomalias, df_anomalias_mensais = refresh_anomalies()
+        except Exception as e:
+            df_anomalias = df_anomalias_mensais = pd.DataFrame()
+            st.warning(f"Não foi possível analisar as transações: {e}")
+
+        col_a1, col_a2 = st.columns(2)
+        with col_a1:
+            st.markdown("#### Transações (Período Selecionado)")
+            if not df_anomalias.empty:
+                df_anomalias['Data'] = pd.to_datetime(df_anomalias['Data'])
+                df_anomalias = df_anomalias[
+                    (df_anomalias['Data'] >= pd.Timestamp(data_inicio)) & (df_anomalias['Data'] <= pd.Timestamp(data_fim))
+                ]
+            if df_anomalias.empty:
+                st.success("Nenhum gasto fora do padrão no período.")
+            else:
+                # Uma linha por transação, mesmo se ela destoar na categoria e no cartão
+                df_anomalias['Comparado com'] = df_anomalias['Dimensao'] + ": " + df_anomalias['Grupo']
+                df_anomalias_view = df_anomalias.sort_values('Score', ascending=False).groupby('id', as_index=False).agg(
+                    Data=('Data', 'first'), Descricao=('Descricao', 'first'), Gasto=('Gasto', 'first'),
+                    Mediana=('Mediana', 'first'), Score=('Score', 'max'), **{'Comparado com': ('Comparado com', ', '.join)}
+                ).sort_values('Data', ascending=False)
+                df_anomalias_view['Data'] = df_anomalias_view['Data'].dt.strftime('%d/%m/%Y')
+                st.dataframe(
+                    df_anomalias_view.set_index('id'),
+                    use_container_width=True,
+                    column_config={
+                        "Gasto": st.column_config.NumberColumn("Gasto (R$)", format="R$ %.2f"),
+                        "Mediana": st.column_config.NumberColumn("Típico (R$)", format="R$ %.2f"),
+                        "Score": st.column_config.NumberColumn(format="%.1f"),
+                    }
+                )
+
+        with col_a2:
+            st.markdown("#### Categorias x Mês (Últimos 12 Meses)")
+            if not df_anomalias_mensais.empty:
+                ultimo_ano = (pd.Period(today_dash, 'M') - 11).strftime('%Y-%m')  # mês atual + 11 anteriores
+                df_anomalias_mensais = df_anomalias_mensais[df_anomalias_mensais['MesAno'] >= ultimo_ano]
+            if df_anomalias_mensais.empty:
+                st.success("Nenhum mês fora do padrão.")
+            else:
+                st.dataframe(
+                    df_anomalias_mensais.sort_values('MesAno', ascending=False),
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        "Gasto": st.column_config.NumberColumn("Gasto (R$)", format="R$ %.2f"),
+                        "Mediana": st.column_config.NumberColumn("Típico (R$)", format="R$ %.2f"),
+                        "Score": st.column_config.NumberColumn(format="%.1f"),
+                    }
+                )
+
+    st.markdown("<br/>", unsafe_allow_html=True)
+
     # --- 4. GRÁFICO: Evolução Mensal ---
     with st.container(border=True):
         st.header("Evolução Mensal (Receita vs. Despesa) 💹")
-        df_full = load_all_transactions()
+        col_evol, col_proj = st.columns(2)
+
+        with col_evol:
+            df_full = load_all_transactions()
         
-        if df_full.empty:
-            st.info("Nenhuma transação registrada ainda.")
-        else:
-            df_full['Data'] = pd.to_datetime(df_full['Data'])
-            df_full['MesAno'] = df_full['Data'].dt.to_period('M').astype(str)
+            if df_full.empty:
+                st.info("Nenhuma transação registrada ainda.")
+            else:
+                df_full['Data'] = pd.to_datetime(df_full['Data'])
+                df_full['MesAno'] = df_full['Data'].dt.to_period('M').astype(str)
             
-            df_despesas_filtradas = df_full[
-                (df_full['Valor'] < 0) & 
-                (df_full['Categoria'] != 'Fatura Cartão')
-            ]
+                df_despesas_filtradas = df_full[
+                    (df_full['Valor'] < 0) & 
+                    (df_full['Categoria'] != 'Fatura Cartão')
+                ]
             
-            df_receitas_evol = df_full[df_full['Valor'] > 0].groupby('MesAno')['Valor'].sum().reset_index()
-            df_receitas_evol.rename(columns={'Valor': 'Receita'}, inplace=True)
+                df_receitas_evol = df_full[df_full['Valor'] > 0].groupby('MesAno')['Valor'].sum().reset_index()
+                df_receitas_evol.rename(columns={'Valor': 'Receita'}, inplace=True)
             
-            df_despesas_evol = df_despesas_filtradas.groupby('MesAno')['Valor'].sum().abs().reset_index()
-            df_despesas_evol.rename(columns={'Valor': 'Despesa'}, inplace=True)
+                df_despesas_evol = df_despesas_filtradas.groupby('MesAno')['Valor'].sum().abs().reset_index()
+                df_despesas_evol.rename(columns={'Valor': 'Despesa'}, inplace=True)
             
-            df_evolucao = pd.merge(df_receitas_evol, df_despesas_evol, on='MesAno', how='outer').fillna(0)
+                df_evolucao = pd.merge(df_receitas_evol, df_despesas_evol, on='MesAno', how='outer').fillna(0)
             
-            df_melted = df_evolucao.melt(
-                id_vars='MesAno', 
-                value_vars=['Receita', 'Despesa'], 
-                var_name='Tipo', 
-                value_name='Valor'
-            )
+                df_melted = df_evolucao.melt(
+                    id_vars='MesAno', 
+                    value_vars=['Receita', 'Despesa'], 
+                    var_name='Tipo', 
+                    value_name='Valor'
+                )
             
-            fig_evolucao = px.bar(
-                df_melted,
-                x='MesAno',
-                y='Valor',
-                color='Tipo',
-                barmode='group',
-                title="Receitas vs Despesas por Mês",
-                color_discrete_map={'Receita': '#28a745', 'Despesa': '#dc3545'}
-            )
-            fig_evolucao.update_layout(template="plotly_dark")
-            st.plotly_chart(fig_evolucao, use_container_width=True)
+                fig_evolucao = px.bar(
+                    df_melted,
+                    x='MesAno',
+                    y='Valor',
+                    color='Tipo',
+                    barmode='group',
+                    title="Receitas vs Despesas por Mês",
+                    color_discrete_map={'Receita': '#28a745', 'Despesa': '#dc3545'}
+                )
+                fig_evolucao.update_layout(template="plotly_dark")
+                st.plotly_chart(fig_evolucao, use_container_width=True)
+
+        # --- 4.0 Projeção (recorrências e parcelamentos) ---
+        with col_proj:
+            anos_projecao = st.slider("Horizonte da projeção (anos)", 1, 10, 2, key="proj_anos")
+            df_regras = load_recurring_rules()
+            df_parcelas = load_installments()
+
+            if df_regras.empty and df_parcelas.empty:
+                st.info("Cadastre recorrências ou parcelamentos abaixo para ver a projeção.")
+            else:
+                proximo_mes = (today_dash.replace(day=1) + timedelta(days=32)).replace(day=1)
+                df_proj, df_faturas_proj = forecast_cash_flow(
+                    df_regras, df_parcelas, proximo_mes.strftime("%Y-%m"), anos_projecao * 12
+                )
+                saldo_atual = load_current_balance(today_dash.strftime("%Y-%m-%d"))
+                df_proj['Saldo Projetado'] = saldo_atual + df_proj['Liquido'].cumsum()
+
+                fig_proj = px.bar(
+                    df_proj.melt(id_vars='MesAno', value_vars=['Receita', 'Despesa'], var_name='Tipo', value_name='Valor'),
+                    x='MesAno',
+                    y='Valor',
+                    color='Tipo',
+                    barmode='group',
+                    title="Projeção: Receitas, Despesas e Saldo",
+                    color_discrete_map={'Receita': '#28a745', 'Despesa': '#dc3545'}
+                )
+                fig_proj.add_scatter(
+                    x=df_proj['MesAno'], y=df_proj['Saldo Projetado'], mode='lines', name='Saldo Projetado'
+                )
+                fig_proj.update_layout(template="plotly_dark")
+                st.plotly_chart(fig_proj, use_container_width=True)
+
+                if df_faturas_proj.empty:
+                    st.info("Nenhuma recorrência ou parcela em cartão de crédito no horizonte.")
+                else:
+                    fig_faturas_proj = px.bar(
+                        df_faturas_proj, x='MesAno', y='ValorFatura', color='Cartao',
+                        title="Faturas Projetadas por Cartão"
+                    )
+                    fig_faturas_proj.update_layout(template="plotly_dark")
+                    st.plotly_chart(fig_faturas_proj, use_container_width=True)
+
+        with st.expander("Gerenciar Recorrências e Parcelamentos 🔁", expanded=False):
+            tab_recorrencia, tab_parcelamento = st.tabs([" Recorrências ", " Parcelamentos "])
+
+            with tab_recorrencia:
+                with st.form("form_recorrencia", clear_on_submit=True):
+                    st.markdown("### Nova Recorrência")
+                    tipo_recorrencia = st.selectbox("Tipo", ["Receita", "Despesa"], key="tipo_rec_regra")
+                    categoria_recorrencia = st.selectbox(
+                        "Categoria", list(dict.fromkeys(CATEGORIAS_RECEITA + CATEGORIAS_DESPESA)), key="cat_rec_regra"
+                    )
+                    descricao_recorrencia = st.text_input("Descrição", key="desc_rec_regra")
+                    valor_recorrencia = st.number_input("Valor Mensal (R$)", min_value=0.01, format="%.2f", step=0.01, key="val_rec_regra")
+                    cartao_recorrencia = st.selectbox("Cartão (só para despesas)", CARTOES, key="cartao_rec_regra")
+                    inicio_recorrencia = st.date_input("Início", today_dash, key="ini_rec_regra")
+                    fim_recorrencia = st.date_input("Fim (opcional)", value=None, key="fim_rec_regra")
+
+                    submit_recorrencia = st.form_submit_button("Salvar Recorrência")
+                    if submit_recorrencia:
+                        try:
+                            is_receita = tipo_recorrencia == "Receita"
+                            save_recurring_rule(
+                                descricao_recorrencia,
+                                categoria_recorrencia,
+                                valor_recorrencia if is_receita else valor_recorrencia * -1,
+                                "N/A" if is_receita else cartao_recorrencia,
+                                inicio_recorrencia.strftime("%Y-%m-%d"),
+                                fim_recorrencia.strftime("%Y-%m-%d") if fim_recorrencia else None
+                            )
+                            st.success("Recorrência salva com sucesso!")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Erro ao salvar: {e}")
+
+                if not df_regras.empty:
+                    st.dataframe(df_regras.set_index('id'), use_container_width=True)
+                    id_regra_excluir = st.selectbox(
+                        "Recorrência para excluir:", df_regras['id'].tolist(),
+                        format_func=lambda id: f"ID: {id} | {df_regras.loc[df_regras['id'] == id, 'Descricao'].iloc[0]}",
+                        key="excluir_regra_select"
+                    )
+                    if st.button("Excluir Recorrência", key="excluir_regra_btn"):
+                        try:
+                            delete_recurring_rule(id_regra_excluir)
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Erro ao excluir: {e}")
+
+            with tab_parcelamento:
+                with st.form("form_parcelamento", clear_on_submit=True):
+                    st.markdown("### Nova Compra Parcelada")
+                    descricao_parcelamento = st.text_input("Descrição", key="desc_parc")
+                    categoria_parcelamento = st.selectbox("Categoria", CATEGORIAS_DESPESA, key="cat_parc")
+                    cartao_parcelamento = st.selectbox("Cartão", CARTOES_CREDITO, key="cartao_parc")
+                    valor_total_parcelamento = st.number_input("Valor Total (R$)", min_value=0.01, format="%.2f", step=0.01, key="val_parc")
+                    num_parcelas = st.number_input("Número de Parcelas", min_value=2, max_value=72, value=10, step=1, key="n_parc")
+                    data_compra = st.date_input("Data da Compra", today_dash, key="data_parc")
+
+                    submit_parcelamento = st.form_submit_button("Salvar Parcelamento")
+                    if submit_parcelamento:
+                        try:
+                            save_installment(
+                                descricao_parcelamento,
+                                categoria_parcelamento,
+                                valor_total_parcelamento,
+                                int(num_parcelas),
+                                data_compra.strftime("%Y-%m-%d"),
+                                cartao_parcelamento
+                            )
+                            st.success(f"Parcelamento em {int(num_parcelas)}x salvo com sucesso!")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Erro ao salvar: {e}")
+
+                if not df_parcelas.empty:
+                    st.dataframe(df_parcelas.set_index('id'), use_container_width=True)
+                    id_parcelamento_excluir = st.selectbox(
+                        "Parcelamento para excluir:", df_parcelas['id'].tolist(),
+                        format_func=lambda id: f"ID: {id} | {df_parcelas.loc[df_parcelas['id'] == id, 'Descricao'].iloc[0]}",
+                        key="excluir_parc_select"
+                    )
+                    if st.button("Excluir Parcelamento", key="excluir_parc_btn"):
+                        try:
+                            delete_installment(id_parcelamento_excluir)
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Erro ao excluir: {e}")
+
+    st.markdown("<br/>", unsafe_allow_html=True)
+
+    # --- 4.1 GRÁFICO: Fluxo de Caixa Diário / Saldo Acumulado ---
+    with st.container(border=True):
+        st.header("Saldo Acumulado Diário 📉")
+        primeira_data, ultima_data = load_date_bounds()
+
+        if primeira_data is None:
+            st.info("Nenhuma transação registrada ainda.")
+        else:
+            if primeira_data == ultima_data:
+                zoom_inicio, zoom_fim = primeira_data, ultima_data
+            else:
+                # Aproximar o intervalo refaz a consulta só nesse trecho, com resolução diária maior
+                zoom_inicio, zoom_fim = st.slider(
+                    "Intervalo do gráfico",
+                    min_value=primeira_data,
+                    max_value=ultima_data,
+                    value=(primeira_data, ultima_data),
+                    format="DD/MM/YYYY",
+                    key="saldo_zoom"
+                )
+
+            df_saldo = load_daily_balance(zoom_inicio.strftime("%Y-%m-%d"), zoom_fim.strftime("%Y-%m-%d"))
+
+            if df_saldo.empty:
+                st.info("Nenhuma transação no intervalo selecionado.")
+            else:
+                df_saldo_plot = downsample_series(df_saldo, 'Data', 'Saldo')
+                fig_saldo = px.line(
+                    df_saldo_plot, x='Data', y='Saldo', hover_data=['Fluxo'],
+                    title="Saldo Acumulado (Receitas - Despesas)"
+                )
+                fig_saldo.update_layout(template="plotly_dark")
+                st.plotly_chart(fig_saldo, use_container_width=True)
+                if len(df_saldo_plot) < len(df_saldo):
+                    st.caption(
+                        f"Exibindo {len(df_saldo_plot)} de {len(df_saldo)} dias (amostragem LTTB). "
+                        "Reduza o intervalo para ver todos os dias."
+                    )
 
     st.markdown("<br/>", unsafe_allow_html=True)
 
@@ -655,6 +1572,36 @@ with tab_dash:
                                     st.success("Transação alterada com sucesso!")
                                     st.rerun()
 
+        # Fora do if/else acima: a busca cobre todo o histórico, não só o período selecionado
+        with st.expander("Possíveis Duplicatas 🔁", expanded=False):
+            st.info("Procura, em todo o histórico, lançamentos com o mesmo valor e cartão, datas próximas e descrições parecidas.")
+            col_dup1, col_dup2 = st.columns(2)
+            with col_dup1:
+                janela_duplicatas = st.number_input(
+                    "Janela (dias)", min_value=0, max_value=30, value=JANELA_DIAS_DUPLICATAS, step=1, key="dup_janela"
+                )
+            with col_dup2:
+                similaridade_duplicatas = st.slider(
+                    "Similaridade mínima da descrição", 0.0, 1.0, SIMILARIDADE_MINIMA, 0.05, key="dup_similaridade"
+                )
+
+            df_duplicatas = load_near_duplicates(int(janela_duplicatas), similaridade_duplicatas)
+            if df_duplicatas.empty:
+                st.success("Nenhuma possível duplicata encontrada.")
+            else:
+                df_duplicatas['Data_a'] = pd.to_datetime(df_duplicatas['Data_a']).dt.strftime('%d/%m/%Y')
+                df_duplicatas['Data_b'] = pd.to_datetime(df_duplicatas['Data_b']).dt.strftime('%d/%m/%Y')
+                st.dataframe(
+                    df_duplicatas,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        "Valor": st.column_config.NumberColumn(format="R$ %.2f"),
+                        "Similaridade": st.column_config.NumberColumn(format="%.2f"),
+                    }
+                )
+                st.caption("Use a aba 'Excluir Transação' (com o período que inclui a data) para remover a cópia.")
+
 # =====================================================================
 # --- PÁGINA 2: CARTÕES DE CRÉDITO ---
 # =====================================================================
@@ -673,7 +1620,7 @@ with tab_cartoes:
         st.header("Cadastrar Fatura Mensal ✍️")
         st.info("Registre o valor *total* da sua fatura de cada cartão para comparar no gráfico de barras.")
         
-        cartoes_de_credito = [c for c in CARTOES if c not in ["Nenhum (Débito/Dinheiro)", "Caju"]]
+        cartoes_de_credito = CARTOES_CREDITO
 
         if not cartoes_de_credito:
             st.warning("Nenhum cartão de crédito cadastrado na lista 'CARTOES'.")
@@ -753,6 +1700,96 @@ with tab_cartoes:
                 use_container_width=True
             )
 
+    st.markdown("<br/>", unsafe_allow_html=True)
+
+    with st.container(border=True):
+        st.header("Conciliação de Faturas 🔍")
+        st.info("Compara o valor declarado de cada fatura com a soma dos gastos lançados no cartão dentro do ciclo da fatura.")
+
+        df_fechamento = load_closing_days()
+        dias_fechamento = dict(zip(df_fechamento['Cartao'], df_fechamento['DiaFechamento']))
+
+        with st.expander("Dias de Fechamento ⚙️", expanded=False):
+            with st.form("form_fechamento", clear_on_submit=True):
+                col_fech1, col_fech2 = st.columns(2)
+                with col_fech1:
+                    cartao_fechamento = st.selectbox("Cartão", CARTOES_CREDITO, key="fechamento_cartao")
+                with col_fech2:
+                    dia_fechamento = st.number_input(
+                        "Dia de Fechamento", min_value=1, max_value=31, value=DIA_FECHAMENTO_PADRAO, step=1, key="fechamento_dia"
+                    )
+                submit_fechamento = st.form_submit_button("Salvar Dia de Fechamento")
+                if submit_fechamento:
+                    try:
+                        save_closing_day(cartao_fechamento, int(dia_fechamento))
+                        st.success(f"Fechamento de {cartao_fechamento} salvo: dia {int(dia_fechamento)}")
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Erro ao salvar: {e}")
+
+            st.dataframe(
+                pd.DataFrame({
+                    'Cartao': CARTOES_CREDITO,
+                    'DiaFechamento': [int(dias_fechamento.get(c, DIA_FECHAMENTO_PADRAO)) for c in CARTOES_CREDITO]
+                }).set_index('Cartao'),
+                use_container_width=True
+            )
+
+        df_conciliacao = load_invoice_reconciliation()
+        if df_conciliacao.empty:
+            st.info("Nenhuma fatura ou gasto no cartão para conciliar.")
+        else:
+            df_conciliacao['Diferenca'] = df_conciliacao['ValorFatura'] - df_conciliacao['ValorGastos']
+            df_conciliacao['Divergente'] = (
+                df_conciliacao['ValorFatura'].isna() | (df_conciliacao['Diferenca'].abs() > TOLERANCIA_CONCILIACAO)
+            )
+
+            so_divergentes = st.checkbox("Mostrar só ciclos divergentes", key="conciliacao_divergentes")
+            df_conciliacao_view = df_conciliacao[df_conciliacao['Divergente']] if so_divergentes else df_conciliacao
+
+            st.dataframe(
+                df_conciliacao_view.style.apply(
+                    lambda row: ['background-color: #5c1a1a' if row['Divergente'] else ''] * len(row), axis=1
+                ),
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "ValorFatura": st.column_config.NumberColumn("Fatura (R$)", format="R$ %.2f"),
+                    "ValorGastos": st.column_config.NumberColumn("Gastos no Ciclo (R$)", format="R$ %.2f"),
+                    "Diferenca": st.column_config.NumberColumn("Diferença (R$)", format="R$ %.2f"),
+                    "NumTransacoes": st.column_config.NumberColumn("Lançamentos"),
+                }
+            )
+
+            st.markdown("#### Detalhar Ciclo")
+            ciclos = list(zip(df_conciliacao_view['Cartao'], df_conciliacao_view['MesAno'], df_conciliacao_view['NumTransacoes']))
+            if not ciclos:
+                st.info("Nenhum ciclo divergente.")
+            else:
+                cartao_ciclo, mes_ciclo, num_transacoes_ciclo = st.selectbox(
+                    "Ciclo:", ciclos, format_func=lambda c: f"{c[0]} | {c[1]} ({c[2]} lançamentos)", key="conciliacao_ciclo"
+                )
+                inicio_ciclo, fim_ciclo = billing_cycle(
+                    mes_ciclo, int(dias_fechamento.get(cartao_ciclo, DIA_FECHAMENTO_PADRAO))
+                )
+                total_paginas = max(1, -(-int(num_transacoes_ciclo) // LINHAS_POR_PAGINA))
+                pagina = st.number_input(
+                    f"Página (de {total_paginas})", min_value=1, max_value=total_paginas, value=1, step=1, key="conciliacao_pagina"
+                )
+                st.caption(f"Ciclo de {inicio_ciclo.strftime('%d/%m/%Y')} a {fim_ciclo.strftime('%d/%m/%Y')}")
+
+                df_ciclo = load_cycle_transactions(
+                    cartao_ciclo, inicio_ciclo.strftime("%Y-%m-%d"), fim_ciclo.strftime("%Y-%m-%d"), int(pagina) - 1
+                )
+                if df_ciclo.empty:
+                    st.info("Nenhum gasto lançado neste ciclo.")
+                else:
+                    df_ciclo['Data'] = df_ciclo['Data'].dt.strftime('%d/%m/%Y')
+                    st.dataframe(
+                        df_ciclo[['id', 'Data', 'Categoria', 'Descricao', 'Valor']].set_index('id'),
+                        use_container_width=True
+                    )
+
 # =====================================================================
 # --- PÁGINA 3: ORÇAMENTO ---
 # =====================================================================
@@ -763,70 +1800,55 @@ with tab_orcamento:
     with st.container(border=True):
         st.header("Definir Limite de Gasto ✍️")
         with st.form("form_orcamento", clear_on_submit=True):
-            col_form1, col_form2 = st.columns(2)
+            col_form1, col_form2, col_form3 = st.columns(3)
             with col_form1:
                 categorias_orcamento = [c for c in CATEGORIAS_DESPESA if c != 'Fatura Cartão']
                 categoria = st.selectbox("Categoria", categorias_orcamento)
             with col_form2:
                 valor = st.number_input("Limite Mensal (R$)", min_value=0.01, format="%.2f", step=0.01)
+            with col_form3:
+                vigencia = st.date_input("Vale a partir do mês de", today_orcamento, key="orcamento_vigencia")
             
             submit_orcamento = st.form_submit_button("Salvar Orçamento")
             if submit_orcamento:
                 try:
-                    save_budget(categoria, valor)
-                    st.success(f"Orçamento para '{categoria}' salvo como R$ {valor:,.2f}")
+                    save_budget(categoria, valor, vigencia.strftime("%Y-%m"))
+                    st.success(f"Orçamento para '{categoria}' salvo como R$ {valor:,.2f} a partir de {vigencia.strftime('%m/%Y')}")
                     st.rerun()
                 except Exception as e:
                     st.error(f"Erro ao salvar: {e}")
 
     st.markdown("<br/>", unsafe_allow_html=True)
 
+    df_orcamentos = load_budgets()
+    df_orcamentos_mensais = load_monthly_budgets()
+    mes_atual = today_orcamento.strftime("%Y-%m")
+
     with st.container(border=True):
         st.header(f"Acompanhamento do Orçamento (Mês Atual: {today_orcamento.strftime('%B/%Y')})")
         
-        df_orcamentos = load_budgets()
-        
-        if df_orcamentos.empty:
+        if df_orcamentos.empty and df_orcamentos_mensais.empty:
             st.info("Nenhum orçamento definido. Adicione limites no formulário acima.")
         else:
-            start_of_month_str = today_orcamento.replace(day=1).strftime("%Y-%m-%d")
-            end_of_month_str = today_orcamento.strftime("%Y-%m-%d")
-            
-            df_transacoes_mes = load_transactions(start_of_month_str, end_of_month_str)
-            
-            df_gastos_mes = df_transacoes_mes[
-                (df_transacoes_mes['Valor'] < 0) & 
-                (df_transacoes_mes['Categoria'] != 'Fatura Cartão')
-            ].copy()
-            
-            if df_gastos_mes.empty:
-                df_gastos_mes_sum = pd.DataFrame(columns=['Categoria', 'Gasto'])
-            else:
-                df_gastos_mes['Gasto'] = df_gastos_mes['Valor'].abs()
-                df_gastos_mes_sum = df_gastos_mes.groupby('Categoria')['Gasto'].sum().reset_index()
-
-            df_comparativo = pd.merge(
-                df_orcamentos, 
-                df_gastos_mes_sum, 
-                on='Categoria', 
-                how='left'
+            df_comparativo = budget_history(
+                df_orcamentos,
+                df_orcamentos_mensais,
+                load_monthly_spending(today_orcamento.replace(day=1).strftime("%Y-%m-%d"), today_orcamento.strftime("%Y-%m-%d")),
+                [mes_atual]
             )
-            
-            df_comparativo['Gasto'] = df_comparativo['Gasto'].fillna(0)
-            df_comparativo['Restante'] = df_comparativo['Valor'] - df_comparativo['Gasto']
-            df_comparativo['Progresso'] = (df_comparativo['Gasto'] / df_comparativo['Valor']).clip(0, 1)
-
-            df_comparativo.rename(columns={'Valor': 'Orçado (R$)', 'Gasto': 'Gasto (R$)', 'Restante': 'Restante (R$)'}, inplace=True)
+            df_comparativo['Progresso'] = (df_comparativo['Uso'] * 100).clip(0, 100)
+            df_comparativo.rename(columns={'Orcado': 'Orçado (R$)', 'Gasto': 'Gasto (R$)', 'Variacao': 'Restante (R$)'}, inplace=True)
 
             st.dataframe(
                 df_comparativo[['Categoria', 'Orçado (R$)', 'Gasto (R$)', 'Restante (R$)', 'Progresso']],
                 use_container_width=True,
+                hide_index=True,
                 column_config={
                     "Progresso": st.column_config.ProgressColumn(
                         "Progresso",
                         format="%.0f%%",
-                        min_val=0,
-                        max_val=1,
+                        min_value=0,
+                        max_value=100,
                     ),
                     "Orçado (R$)": st.column_config.NumberColumn(format="R$ %.2f"),
                     "Gasto (R$)": st.column_config.NumberColumn(format="R$ %.2f"),
@@ -834,15 +1856,61 @@ with tab_orcamento:
                 }
             )
 
-            st.markdown("### Detalhes do Progresso")
-            for index, row in df_comparativo.iterrows():
-                st.markdown(f"**{row['Categoria']}** (Restante: R$ {row['Restante (R$)']:,.2f})")
-                
-                if row['Progresso'] >= 1.0:
-                    st.error(f"Gasto: R$ {row['Gasto (R$)']:,.2f} de R$ {row['Orçado (R$)']:,.2f}")
-                    st.progress(1.0)
-                else:
-                    st.success(f"Gasto: R$ {row['Gasto (R$)']:,.2f} de R$ {row['Orçado (R$)']:,.2f}")
-                    st.progress(row['Progresso'])
+            estourados = df_comparativo[df_comparativo['Restante (R$)'] < 0]['Categoria'].tolist()
+            if estourados:
+                st.error(f"Orçamento estourado em: {', '.join(estourados)}")
 
+    st.markdown("<br/>", unsafe_allow_html=True)
+
+    with st.container(border=True):
+        st.header("Histórico do Orçamento 🗓️")
+        primeira_data, _ = load_date_bounds()
+
+        if (df_orcamentos.empty and df_orcamentos_mensais.empty) or primeira_data is None:
+            st.info("Defina orçamentos e registre despesas para ver o histórico.")
+        else:
+            # Lançamentos futuros (ex: salário do mês que vem) não podem deixar o intervalo vazio
+            fim_disponivel = max(primeira_data, today_orcamento.date())
+            meses_disponiveis = pd.period_range(primeira_data, fim_disponivel, freq='M').astype(str).tolist()
+            if len(meses_disponiveis) > 1:
+                mes_inicio_hist, mes_fim_hist = st.select_slider(
+                    "Período",
+                    options=meses_disponiveis,
+                    value=(meses_disponiveis[max(0, len(meses_disponiveis) - 12)], meses_disponiveis[-1]),
+                    key="orcamento_hist_periodo"
+                )
+            else:
+                mes_inicio_hist = mes_fim_hist = meses_disponiveis[0]
+            meses_hist = pd.period_range(mes_inicio_hist, mes_fim_hist, freq='M').astype(str).tolist()
+
+            df_gastos_hist = load_monthly_spending(
+                f"{mes_inicio_hist}-01", pd.Period(mes_fim_hist, 'M').end_time.strftime("%Y-%m-%d")
+            )
+            df_historico = budget_history(df_orcamentos, df_orcamentos_mensais, df_gastos_hist, meses_hist)
+
+            if df_historico.empty:
+                st.info("Nenhum orçamento vigente no período.")
+            else:
+                df_uso = df_historico.pivot(index='Categoria', columns='MesAno', values='Uso') * 100
+                fig_heatmap = px.imshow(
+                    df_uso,
+                    color_continuous_scale=["#28a745", "#ffc107", "#dc3545"],
+                    range_color=[0, 150],
+                    aspect="auto",
+                    text_auto=".0f",
+                    labels=dict(x="Mês", y="Categoria", color="% do Orçado"),
+                    title="Gasto como % do Orçado"
+                )
+                fig_heatmap.update_layout(template="plotly_dark")
+                st.plotly_chart(fig_heatmap, use_container_width=True)
+
+                st.markdown("#### Variação (Orçado - Gasto) por Mês")
+                st.dataframe(
+                    df_historico.pivot(index='Categoria', columns='MesAno', values='Variacao'),
+                    use_container_width=True,
+                    column_config={m: st.column_config.NumberColumn(format="R$ %.2f") for m in meses_hist}
+                )
 
+# --- Estatísticas do cache (no fim do script, depois de todas as consultas desta execução) ---
+with st.sidebar.expander("Cache de Transações 🗄️", expanded=False):
+    st.json(get_transaction_cache().stats())
@@ -0,0 +1,183 @@
+"""Camada de dados do app, compartilhada entre app.py e load_test_sqlite.py.
+
+Reúne as constantes de domínio usadas nas consultas (categorias, cartões), as
+consultas SQL e a conexão do fallback SQLite com busy_timeout e retry com
+backoff. O teste de carga importa este módulo para medir exatamente o mesmo
+código que o app executa.
+
+Consultas com parâmetros estão no dialeto do SQLite (placeholders `?`); as sem
+parâmetros valem para os dois bancos. As variantes do Postgres (placeholders
+`:nome`, to_char, date_trunc) ficam em app.py, ao lado de cada função, exceto
+MES_FATURA_SQL, que fica aqui junto do template SQL_CONCILIACAO que a usa.
+"""
+import random
+import sqlite3
+import time
+
+import pandas as pd
+
+CATEGORIAS_RECEITA = [
+    "Salário", "Freelance", "Investimentos", "Presente", "Conta Corrente",
+    "Caju", "Outros"
+]
+CATEGORIAS_DESPESA = [
+    "Alimentação", "Transporte", "Lazer", "Saúde", "Educação",
+    "Compras", "Fatura Cartão", "Outros"
+]
+CARTOES = [
+    "Nenhum (Débito/Dinheiro)", "Nubank", "Mercado Pago", "C6",
+    "Elo", "Azul", "Caju", "Outro"
+]
+CARTOES_CREDITO = [c for c in CARTOES if c not in ["Nenhum (Débito/Dinheiro)", "Caju"]]
+
+DIA_FECHAMENTO_PADRAO = 31  # Sem configuração, o ciclo da fatura é o próprio mês calendário
+LINHAS_POR_PAGINA = 50  # Paginação do detalhamento do ciclo de fatura
+
+# --- Esquema (SQLite) ---
+SQLITE_TABELAS = [
+    """
+    CREATE TABLE IF NOT EXISTS transacoes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, Data TEXT NOT NULL, Categoria TEXT NOT NULL,
+        Descricao TEXT, Valor REAL NOT NULL, Cartao TEXT DEFAULT 'N/A', Fingerprint TEXT
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS faturas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, Cartao TEXT NOT NULL, MesAno TEXT NOT NULL, ValorFatura REAL NOT NULL
+    )""",
+    "CREATE TABLE IF NOT EXISTS orcamentos ( Categoria TEXT PRIMARY KEY, Valor REAL NOT NULL )",
+    """
+    CREATE TABLE IF NOT EXISTS recorrencias (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, Descricao TEXT, Categoria TEXT NOT NULL, Valor REAL NOT NULL,
+        Cartao TEXT DEFAULT 'N/A', Inicio TEXT NOT NULL, Fim TEXT
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS parcelamentos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, Descricao TEXT, Categoria TEXT NOT NULL, ValorTotal REAL NOT NULL,
+        NumParcelas INTEGER NOT NULL, DataCompra TEXT NOT NULL, Cartao TEXT DEFAULT 'N/A'
+    )""",
+    "CREATE TABLE IF NOT EXISTS cartoes_fechamento ( Cartao TEXT PRIMARY KEY, DiaFechamento INTEGER NOT NULL )",
+    "CREATE INDEX IF NOT EXISTS idx_transacoes_cartao_data ON transacoes (Cartao, Data)",
+    "CREATE INDEX IF NOT EXISTS idx_faturas_cartao_mesano ON faturas (Cartao, MesAno)",
+    """
+    CREATE TABLE IF NOT EXISTS orcamentos_mensais (
+        Categoria TEXT NOT NULL, MesAno TEXT NOT NULL, Valor REAL NOT NULL, PRIMARY KEY (Categoria, MesAno)
+    )""",
+]
+# Criado depois da migração que adiciona a coluna Fingerprint em bancos antigos
+SQL_INDICE_FINGERPRINT = "CREATE INDEX IF NOT EXISTS idx_transacoes_fingerprint ON transacoes (Fingerprint)"
+
+# --- Transações ---
+SQL_LOAD_TRANSACTIONS = "SELECT * FROM transacoes WHERE Data BETWEEN ? AND ? ORDER BY Data DESC"
+SQL_LOAD_ALL_TRANSACTIONS = "SELECT * FROM transacoes ORDER BY Data DESC"
+SQL_LOAD_TRANSACTIONS_SINCE = "SELECT * FROM transacoes WHERE id > ? ORDER BY id"
+SQL_FIND_FINGERPRINT = "SELECT id FROM transacoes WHERE Fingerprint = ? LIMIT 1"
+SQL_SAVE_TRANSACTION = "INSERT INTO transacoes (Data, Categoria, Descricao, Valor, Cartao, Fingerprint) VALUES (?, ?, ?, ?, ?, ?)"
+SQL_UPDATE_TRANSACTION = """UPDATE transacoes
+               SET Data = ?, Categoria = ?, Descricao = ?, Valor = ?, Cartao = ?, Fingerprint = ?
+               WHERE id = ?"""
+SQL_DELETE_TRANSACTION = "DELETE FROM transacoes WHERE id = ?"
+SQL_LOAD_NEAR_DUPLICATES = (
+    "SELECT id, Data, Descricao, Valor, Cartao, Fingerprint FROM transacoes WHERE Fingerprint IS NOT NULL ORDER BY Fingerprint"
+)
+
+# --- Faturas, orçamentos e dias de fechamento ---
+SQL_LOAD_FATURAS = "SELECT * FROM faturas ORDER BY MesAno"
+SQL_LOAD_BUDGETS = "SELECT * FROM orcamentos"
+SQL_LOAD_MONTHLY_BUDGETS = "SELECT * FROM orcamentos_mensais ORDER BY Categoria, MesAno"
+SQL_LOAD_MONTHLY_SPENDING = """SELECT Categoria, strftime('%Y-%m', Data) AS MesAno, SUM(-Valor) AS Gasto FROM transacoes
+                              WHERE Valor < 0 AND Categoria != 'Fatura Cartão' AND Data BETWEEN ? AND ?
+                              GROUP BY Categoria, strftime('%Y-%m', Data)"""
+SQL_LOAD_CLOSING_DAYS = "SELECT * FROM cartoes_fechamento"
+
+# --- Conciliação de Faturas ---
+# O gasto no dia D entra na fatura do próprio mês se D <= dia de fechamento do cartão, senão na do mês seguinte.
+# Só a última fatura cadastrada (maior id) de cada Cartao/MesAno é considerada.
+SQL_CONCILIACAO = """
+WITH gastos AS (
+    SELECT t.Cartao, {mes_fatura} AS MesAno, SUM(-t.Valor) AS ValorGastos, COUNT(*) AS NumTransacoes
+    FROM transacoes t LEFT JOIN cartoes_fechamento c ON c.Cartao = t.Cartao
+    WHERE t.Cartao IN ({cartoes}) AND t.Valor < 0 AND t.Categoria != 'Fatura Cartão'
+    GROUP BY t.Cartao, {mes_fatura}
+),
+faturas_atuais AS (
+    SELECT Cartao, MesAno, ValorFatura FROM faturas
+    WHERE id IN (SELECT MAX(id) FROM faturas GROUP BY Cartao, MesAno)
+)
+SELECT f.Cartao, f.MesAno, f.ValorFatura,
+       COALESCE(g.ValorGastos, 0) AS ValorGastos, COALESCE(g.NumTransacoes, 0) AS NumTransacoes
+FROM faturas_atuais f LEFT JOIN gastos g ON g.Cartao = f.Cartao AND g.MesAno = f.MesAno
+UNION ALL
+SELECT g.Cartao, g.MesAno, NULL, g.ValorGastos, g.NumTransacoes
+FROM gastos g
+WHERE NOT EXISTS (SELECT 1 FROM faturas_atuais f WHERE f.Cartao = g.Cartao AND f.MesAno = g.MesAno)
+ORDER BY MesAno DESC, Cartao
+"""
+MES_FATURA_SQL = f"""to_char(
+        date_trunc('month', t.Data) + CASE WHEN EXTRACT(DAY FROM t.Data) > COALESCE(c.DiaFechamento, {DIA_FECHAMENTO_PADRAO})
+                                          THEN INTERVAL '1 month' ELSE INTERVAL '0 month' END,
+        'YYYY-MM')"""
+MES_FATURA_SQLITE = f"""strftime('%Y-%m', t.Data, 'start of month',
+        CASE WHEN CAST(strftime('%d', t.Data) AS INTEGER) > COALESCE(c.DiaFechamento, {DIA_FECHAMENTO_PADRAO})
+             THEN '+1 month' ELSE '+0 months' END)"""
+
+
+def sqlite_reconciliation_query(cartoes):
+    """SQL_CONCILIACAO no dialeto SQLite, com um placeholder por cartão."""
+    return SQL_CONCILIACAO.format(mes_fatura=MES_FATURA_SQLITE, cartoes=", ".join("?" for _ in cartoes))
+
+
+SQL_LOAD_CYCLE_TRANSACTIONS = """SELECT * FROM transacoes
+                              WHERE Cartao = ? AND Data BETWEEN ? AND ? AND Valor < 0 AND Categoria != 'Fatura Cartão'
+                              ORDER BY Data, id LIMIT ? OFFSET ?"""
+
+# --- Recorrências, parcelamentos e saldo ---
+SQL_LOAD_RECURRING_RULES = "SELECT * FROM recorrencias ORDER BY Inicio"
+SQL_LOAD_INSTALLMENTS = "SELECT * FROM parcelamentos ORDER BY DataCompra"
+SQL_LOAD_CURRENT_BALANCE = "SELECT SUM(Valor) AS Saldo FROM transacoes WHERE Categoria != 'Fatura Cartão' AND Data <= ?"
+
+# --- Séries temporais (saldo diário) ---
+SQL_LOAD_DATE_BOUNDS = "SELECT MIN(Data) AS Inicio, MAX(Data) AS Fim FROM transacoes"
+SQL_LOAD_DAILY_BALANCE = """
+            SELECT Data, Fluxo, Saldo FROM (
+                SELECT Data, SUM(Valor) AS Fluxo, SUM(SUM(Valor)) OVER (ORDER BY Data) AS Saldo
+                FROM transacoes WHERE Categoria != 'Fatura Cartão' GROUP BY Data
+            ) diario WHERE Data BETWEEN ? AND ? ORDER BY Data
+            """
+
+
+# --- Conexão SQLite ---
+def connect_sqlite(db_path, busy_timeout_ms):
+    db_conn = sqlite3.connect(db_path, timeout=busy_timeout_ms / 1000, check_same_thread=False)
+    db_conn.execute(f"PRAGMA busy_timeout = {busy_timeout_ms}")
+    return db_conn
+
+
+def is_sqlite_lock_error(e):
+    # pd.read_sql_query embrulha o erro do sqlite3 em pandas.errors.DatabaseError
+    if isinstance(e, pd.errors.DatabaseError) and e.__cause__ is not None:
+        e = e.__cause__
+    msg = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in msg or "busy" in msg)
+
+
+def execute_with_retry(connect, operacao, max_retries, backoff, ao_repetir=None):
+    """Executa `operacao(db_conn)` em uma conexão nova de `connect()`, repetindo com backoff se o banco estiver bloqueado.
+
+    Depois de `max_retries` novas tentativas o erro de bloqueio sobe para quem chamou;
+    `ao_repetir`, se dado, é chamado a cada nova tentativa (o teste de carga conta por ele).
+    """
+    for tentativa in range(max_retries + 1):
+        db_conn = connect()
+        try:
+            resultado = operacao(db_conn)
+            db_conn.commit()
+            return resultado
+        except (sqlite3.OperationalError, pd.errors.DatabaseError) as e:
+            if not is_sqlite_lock_error(e) or tentativa == max_retries:
+                raise
+            if ao_repetir is not None:
+                ao_repetir()
+            # Backoff exponencial com jitter para as sessões não tentarem todas ao mesmo tempo
+            time.sleep(backoff * (2 ** tentativa) * random.uniform(0.5, 1.5))
+        finally:
+            db_conn.close()
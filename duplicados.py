@@ -0,0 +1,107 @@
+"""Impressão digital (fingerprint) de transações e busca de quase-duplicatas.
+
+O fingerprint é uma string determinística com o formato
+
+    <valor em centavos>|<cartão normalizado>|<data YYYY-MM-DD>|<hash da descrição normalizada>
+
+guardada na coluna indexada `transacoes.Fingerprint`. Duplicatas exatas são uma
+busca por igualdade no índice. O prefixo "<centavos>|<cartão>|" agrupa candidatos
+a quase-duplicata (mesmo valor, mesmo cartão), e dentro de cada grupo só são
+comparadas transações a poucos dias de distância, então a busca nunca compara
+todos os pares.
+"""
+import difflib
+import hashlib
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+JANELA_DIAS_DUPLICATAS = 3
+SIMILARIDADE_MINIMA = 0.8
+MAX_VIZINHOS = 50  # limite de comparações por transação dentro do grupo (só importa em grupos muito densos)
+
+COLUNAS_DUPLICATAS = [
+    "id_a", "id_b", "Data_a", "Data_b", "Descricao_a", "Descricao_b", "Valor", "Cartao", "Similaridade", "Exata"
+]
+
+
+def normalize_text(texto):
+    """Minúsculas, sem acentos, só letras/números separados por um espaço."""
+    if texto is None or (isinstance(texto, float) and np.isnan(texto)):
+        return ""
+    texto = unicodedata.normalize("NFKD", str(texto))
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", texto).split())
+
+
+def bucket_prefix(valor, cartao):
+    return f"{int(round(float(valor) * 100))}|{normalize_text(cartao)}|"
+
+
+def transaction_fingerprint(data, descricao, valor, cartao):
+    """Fingerprint de uma transação; `data` pode ser 'YYYY-MM-DD', date ou Timestamp."""
+    data_iso = pd.Timestamp(data).strftime("%Y-%m-%d")
+    descricao_hash = hashlib.sha1(normalize_text(descricao).encode("utf-8")).hexdigest()[:12]
+    return f"{bucket_prefix(valor, cartao)}{data_iso}|{descricao_hash}"
+
+
+def find_near_duplicates(df, janela_dias=JANELA_DIAS_DUPLICATAS, similaridade_minima=SIMILARIDADE_MINIMA):
+    """Pares de transações com mesmo valor e cartão, até `janela_dias` de distância e descrições parecidas.
+
+    `df` precisa de id, Data, Descricao, Valor, Cartao e Fingerprint. As linhas são
+    ordenadas por prefixo do fingerprint e data; para k = 1, 2, ... cada linha é
+    comparada com a k-ésima seguinte enquanto ainda houver algum par no mesmo
+    grupo e dentro da janela. O custo é proporcional a n vezes a densidade de
+    transações iguais na janela, não a n².
+    """
+    if df.empty:
+        return pd.DataFrame(columns=COLUNAS_DUPLICATAS)
+
+    ordenado = df.assign(
+        Prefixo=df["Fingerprint"].str.rsplit("|", n=2).str[0],
+        Data=pd.to_datetime(df["Data"]),
+    ).sort_values(["Prefixo", "Data", "id"]).reset_index(drop=True)
+
+    prefixo = ordenado["Prefixo"].to_numpy()
+    dias = ordenado["Data"].to_numpy().astype("datetime64[D]").astype(np.int64)
+    n = len(ordenado)
+
+    pares_a, pares_b = [], []
+    for k in range(1, min(MAX_VIZINHOS, n - 1) + 1):
+        candidatos = (prefixo[:-k] == prefixo[k:]) & (dias[k:] - dias[:-k] <= janela_dias)
+        if not candidatos.any():
+            break
+        i = np.flatnonzero(candidatos)
+        pares_a.append(i)
+        pares_b.append(i + k)
+
+    if not pares_a:
+        return pd.DataFrame(columns=COLUNAS_DUPLICATAS)
+
+    a = np.concatenate(pares_a)
+    b = np.concatenate(pares_b)
+    exata = ordenado["Fingerprint"].to_numpy()[a] == ordenado["Fingerprint"].to_numpy()[b]
+
+    # Similaridade de texto só para os candidatos já filtrados por valor, cartão e data
+    descricoes = ordenado["Descricao"].map(normalize_text).to_numpy()
+    similaridade = np.array([
+        1.0 if e else difflib.SequenceMatcher(None, descricoes[x], descricoes[y]).ratio()
+        for x, y, e in zip(a, b, exata)
+    ])
+
+    manter = similaridade >= similaridade_minima
+    a, b = a[manter], b[manter]
+    return pd.DataFrame({
+        "id_a": ordenado["id"].to_numpy()[a],
+        "id_b": ordenado["id"].to_numpy()[b],
+        "Data_a": ordenado["Data"].to_numpy()[a],
+        "Data_b": ordenado["Data"].to_numpy()[b],
+        "Descricao_a": ordenado["Descricao"].to_numpy()[a],
+        "Descricao_b": ordenado["Descricao"].to_numpy()[b],
+        "Valor": ordenado["Valor"].to_numpy()[a],
+        "Cartao": ordenado["Cartao"].to_numpy()[a],
+        "Similaridade": similaridade[manter],
+        "Exata": exata[manter],
+    }).sort_values(["Exata", "Similaridade"], ascending=False).reset_index(drop=True)
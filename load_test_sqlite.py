@@ -0,0 +1,389 @@
+"""Teste de carga do fallback SQLite do app.
+
+Simula N sessões concorrentes (threads ou processos) executando o mesmo mix de
+leitura/escrita do app.py: carregamento do dashboard, save_transaction,
+update_transaction e delete_transaction. As consultas vêm de consultas.py e as
+leituras passam por pd.read_sql_query, como no app; os ajustes de concorrência
+(busy_timeout, retry com backoff, journal_mode) são os mesmos, para que os
+valores medidos aqui possam ser levados para as variáveis de ambiente SQLITE_*
+lidas pelo app.py.
+
+Com --db o teste roda sobre uma cópia do arquivo em um diretório temporário;
+--in-place usa o próprio arquivo (o teste insere, altera e exclui transações).
+
+Exemplo:
+    python load_test_sqlite.py --sessions 16 --mode process --duration 30 --busy-timeout 0 --retries 0
+    python load_test_sqlite.py --sessions 16 --mode process --duration 30 --busy-timeout 5000 --journal-mode WAL
+    python load_test_sqlite.py --db financeiro.db --sessions 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+from consultas import (
+    CATEGORIAS_DESPESA, CARTOES, CARTOES_CREDITO, LINHAS_POR_PAGINA, connect_sqlite, execute_with_retry,
+    SQLITE_TABELAS, SQL_INDICE_FINGERPRINT,
+    SQL_LOAD_TRANSACTIONS, SQL_LOAD_ALL_TRANSACTIONS, SQL_LOAD_TRANSACTIONS_SINCE, SQL_FIND_FINGERPRINT,
+    SQL_SAVE_TRANSACTION, SQL_UPDATE_TRANSACTION, SQL_DELETE_TRANSACTION, SQL_LOAD_NEAR_DUPLICATES,
+    SQL_LOAD_FATURAS, SQL_LOAD_BUDGETS, SQL_LOAD_MONTHLY_BUDGETS, SQL_LOAD_MONTHLY_SPENDING, SQL_LOAD_CLOSING_DAYS,
+    SQL_LOAD_CYCLE_TRANSACTIONS, SQL_LOAD_RECURRING_RULES, SQL_LOAD_INSTALLMENTS, SQL_LOAD_CURRENT_BALANCE,
+    SQL_LOAD_DATE_BOUNDS, SQL_LOAD_DAILY_BALANCE, sqlite_reconciliation_query, is_sqlite_lock_error
+)
+from duplicados import transaction_fingerprint, find_near_duplicates
+
+CATEGORIAS_ORCAMENTO = [c for c in CATEGORIAS_DESPESA if c != "Fatura Cartão"]  # como no formulário de orçamento
+
+# Peso de cada operação no mix (a maior parte das execuções do Streamlit são leituras do dashboard)
+MIX_PADRAO = {"dashboard": 0.70, "save": 0.15, "update": 0.10, "delete": 0.05}
+
+
+class LockError(Exception):
+    pass
+
+
+class DataLayer:
+    """Mesma conexão e retry do app (connect_sqlite/execute_with_retry de consultas.py) com parâmetros ajustáveis."""
+
+    def __init__(self, db_path, busy_timeout_ms, max_retries, backoff):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retries = 0
+        self.ultimo_id = 0  # último id visto pelo detector de anomalias desta sessão
+
+    def connect(self):
+        return connect_sqlite(self.db_path, self.busy_timeout_ms)
+
+    def run(self, operacao):
+        try:
+            return execute_with_retry(self.connect, operacao, self.max_retries, self.backoff, self._contar_retry)
+        except (sqlite3.OperationalError, pd.errors.DatabaseError) as e:
+            # Bloqueio que sobrou depois de todas as tentativas: é o erro que o usuário do app veria
+            if is_sqlite_lock_error(e):
+                raise LockError(str(e)) from e
+            raise
+
+    def _contar_retry(self):
+        self.retries += 1
+
+    def read(self, query, params=()):
+        # Mesmo caminho de leitura do app: pd.read_sql_query dentro do retry
+        return self.run(lambda c: pd.read_sql_query(query, c, params=params))
+
+    # --- Operações do app ---
+    def dashboard(self, hoje):
+        """Tudo o que uma execução do app lê com o cache frio (toda escrita limpa o cache), na ordem das abas."""
+        inicio_mes, fim = hoje.replace(day=1).isoformat(), hoje.isoformat()
+
+        # Dashboard: período, anomalias (só ids novos), evolução, projeção, saldo diário e duplicatas
+        self.read(SQL_LOAD_TRANSACTIONS, (inicio_mes, fim))
+        novas = self.read(SQL_LOAD_TRANSACTIONS_SINCE, (self.ultimo_id,))
+        if not novas.empty:
+            self.ultimo_id = int(novas['id'].max())
+        self.read(SQL_LOAD_ALL_TRANSACTIONS)
+        self.read(SQL_LOAD_RECURRING_RULES)
+        self.read(SQL_LOAD_INSTALLMENTS)
+        self.read(SQL_LOAD_CURRENT_BALANCE, (fim,))
+        limites = self.read(SQL_LOAD_DATE_BOUNDS)
+        if not pd.isna(limites.iloc[0, 0]):
+            self.read(SQL_LOAD_DAILY_BALANCE, (limites.iloc[0, 0], limites.iloc[0, 1]))
+        find_near_duplicates(self.read(SQL_LOAD_NEAR_DUPLICATES))
+
+        # Cartões: faturas, dias de fechamento, conciliação e a primeira página do ciclo detalhado
+        self.read(SQL_LOAD_FATURAS)
+        self.read(SQL_LOAD_CLOSING_DAYS)
+        conciliacao = self.read(sqlite_reconciliation_query(CARTOES_CREDITO), tuple(CARTOES_CREDITO))
+        if not conciliacao.empty:
+            self.read(SQL_LOAD_CYCLE_TRANSACTIONS, (conciliacao.iloc[0, 0], inicio_mes, fim, LINHAS_POR_PAGINA, 0))
+
+        # Orçamento: base, versões, gasto do mês e histórico
+        self.read(SQL_LOAD_BUDGETS)
+        self.read(SQL_LOAD_MONTHLY_BUDGETS)
+        self.read(SQL_LOAD_MONTHLY_SPENDING, (inicio_mes, fim))
+        if not pd.isna(limites.iloc[0, 0]):
+            self.read(SQL_LOAD_MONTHLY_SPENDING, (limites.iloc[0, 0], fim))
+
+    def save(self, rng, hoje):
+        # Mesmo caminho do save_transaction com duplicados="sinalizar": checagem e INSERT em BEGIN IMMEDIATE
+        transacao = random_transaction(rng, hoje)
+
+        def inserir(c):
+            c.execute("BEGIN IMMEDIATE")
+            c.execute(SQL_FIND_FINGERPRINT, (transacao[-1],)).fetchone()
+            c.execute(SQL_SAVE_TRANSACTION, transacao)
+
+        self.run(inserir)
+
+    def update(self, rng, hoje):
+        id = self.random_id(rng)
+        if id is not None:
+            self.run(lambda c: c.execute(SQL_UPDATE_TRANSACTION, random_transaction(rng, hoje) + (id,)))
+            self.ultimo_id = 0  # Edição/exclusão faz o app refazer o lote do detector
+
+    def delete(self, rng):
+        id = self.random_id(rng)
+        if id is not None:
+            self.run(lambda c: c.execute(SQL_DELETE_TRANSACTION, (id,)))
+            self.ultimo_id = 0
+
+    def random_id(self, rng):
+        # Na UI o id vem da tabela já carregada; aqui sorteamos entre os existentes
+        limites = self.run(lambda c: c.execute("SELECT MIN(id), MAX(id) FROM transacoes").fetchone())
+        if limites[0] is None:
+            return None
+        return rng.randint(limites[0], limites[1])
+
+
+def random_transaction(rng, hoje):
+    data = hoje - timedelta(days=rng.randint(0, 365))
+    descricao = f"Teste de carga {rng.randint(0, 10**6)}"
+    valor = -round(rng.uniform(1, 500), 2)
+    cartao = rng.choice(CARTOES)
+    return (
+        data.isoformat(),
+        rng.choice(CATEGORIAS_DESPESA),
+        descricao,
+        valor,
+        cartao,
+        transaction_fingerprint(data.isoformat(), descricao, valor, cartao),
+    )
+
+
+def seed_database(db_path, rows, journal_mode):
+    """Cria o esquema do app e popula todas as tabelas lidas pelo dashboard."""
+    db_conn = sqlite3.connect(db_path)
+    if journal_mode:
+        db_conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    for ddl in SQLITE_TABELAS + [SQL_INDICE_FINGERPRINT]:
+        db_conn.execute(ddl)
+    rng = random.Random(0)
+    hoje = date.today()
+    db_conn.executemany(SQL_SAVE_TRANSACTION, [random_transaction(rng, hoje) for _ in range(rows)])
+    db_conn.executemany(
+        "INSERT OR REPLACE INTO orcamentos (Categoria, Valor) VALUES (?, ?)",
+        [(c, 1000.0) for c in CATEGORIAS_ORCAMENTO],
+    )
+    meses = sorted({(hoje - timedelta(days=30 * i)).strftime("%Y-%m") for i in range(12)})
+    db_conn.executemany(
+        "INSERT OR REPLACE INTO orcamentos_mensais (Categoria, MesAno, Valor) VALUES (?, ?, ?)",
+        [(c, m, 1200.0) for c in CATEGORIAS_ORCAMENTO for m in meses[::3]],
+    )
+    db_conn.executemany(
+        "INSERT INTO faturas (Cartao, MesAno, ValorFatura) VALUES (?, ?, ?)",
+        [(c, m, round(rng.uniform(500, 5000), 2)) for c in CARTOES_CREDITO for m in meses],
+    )
+    db_conn.executemany(
+        "INSERT OR REPLACE INTO cartoes_fechamento (Cartao, DiaFechamento) VALUES (?, ?)",
+        [(c, rng.randint(1, 28)) for c in CARTOES_CREDITO[::2]],
+    )
+    db_conn.executemany(
+        "INSERT INTO recorrencias (Descricao, Categoria, Valor, Cartao, Inicio, Fim) VALUES (?, ?, ?, ?, ?, ?)",
+        [(f"Assinatura {i}", rng.choice(CATEGORIAS_ORCAMENTO), -round(rng.uniform(10, 200), 2),
+          rng.choice(CARTOES), meses[0] + "-01", None) for i in range(10)],
+    )
+    db_conn.executemany(
+        """INSERT INTO parcelamentos (Descricao, Categoria, ValorTotal, NumParcelas, DataCompra, Cartao)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        [(f"Compra parcelada {i}", "Compras", round(rng.uniform(300, 3000), 2), rng.randint(2, 12),
+          (hoje - timedelta(days=rng.randint(0, 365))).isoformat(), rng.choice(CARTOES_CREDITO)) for i in range(10)],
+    )
+    db_conn.commit()
+    db_conn.close()
+
+
+def copy_database(origem, destino):
+    """Cópia consistente (inclui o que ainda está no WAL) via API de backup do sqlite3."""
+    src = sqlite3.connect(origem)
+    dst = sqlite3.connect(destino)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def run_session(session_id, args, deadline):
+    """Executa o mix até o deadline e devolve as amostras (operação, latência, status)."""
+    rng = random.Random(args.seed + session_id)
+    layer = DataLayer(args.db, args.busy_timeout, args.retries, args.backoff)
+    hoje = date.today()
+    ops = list(MIX_PADRAO)
+    pesos = [MIX_PADRAO[o] for o in ops]
+    amostras = []
+    while time.time() < deadline:
+        op = rng.choices(ops, weights=pesos)[0]
+        inicio = time.perf_counter()
+        status = "ok"
+        try:
+            if op == "dashboard":
+                layer.dashboard(hoje)
+            elif op == "save":
+                layer.save(rng, hoje)
+            elif op == "update":
+                layer.update(rng, hoje)
+            else:
+                layer.delete(rng)
+        except LockError:
+            status = "lock"
+        except (sqlite3.Error, pd.errors.DatabaseError):
+            status = "error"
+        amostras.append((op, time.perf_counter() - inicio, status))
+        if args.think_time:
+            time.sleep(rng.uniform(0, 2 * args.think_time))
+    return {"amostras": amostras, "retries": layer.retries}
+
+
+def _process_worker(session_id, args, deadline, fila):
+    fila.put(run_session(session_id, args, deadline))
+
+
+def run_load(args):
+    deadline = time.time() + args.duration
+    resultados = []
+    if args.mode == "thread":
+        lock = threading.Lock()
+
+        def worker(i):
+            r = run_session(i, args, deadline)
+            with lock:
+                resultados.append(r)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.sessions)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    else:
+        fila = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=_process_worker, args=(i, args, deadline, fila))
+            for i in range(args.sessions)
+        ]
+        for p in procs:
+            p.start()
+        # Lê a fila antes do join para não travar em resultados grandes
+        for _ in procs:
+            resultados.append(fila.get())
+        for p in procs:
+            p.join()
+    return resultados
+
+
+def percentile(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = max(0, min(len(ordenados) - 1, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[k]
+
+
+def summarize(resultados, duracao):
+    amostras = [a for r in resultados for a in r["amostras"]]
+    resumo = {"total": {}, "por_operacao": {}, "retries": sum(r["retries"] for r in resultados)}
+
+    def stats(lista):
+        latencias = [a[1] for a in lista]
+        n = len(lista)
+        return {
+            "ops": n,
+            "throughput_ops_s": n / duracao if duracao else 0.0,
+            "p50_ms": percentile(latencias, 50) * 1000,
+            "p95_ms": percentile(latencias, 95) * 1000,
+            "p99_ms": percentile(latencias, 99) * 1000,
+            "media_ms": (statistics.fmean(latencias) * 1000) if latencias else 0.0,
+            "lock_error_rate": (sum(1 for a in lista if a[2] == "lock") / n) if n else 0.0,
+            "other_error_rate": (sum(1 for a in lista if a[2] == "error") / n) if n else 0.0,
+        }
+
+    resumo["total"] = stats(amostras)
+    for op in MIX_PADRAO:
+        resumo["por_operacao"][op] = stats([a for a in amostras if a[0] == op])
+    return resumo
+
+
+def print_report(resumo, args):
+    print(
+        f"\nSessões: {args.sessions} ({args.mode}) | duração: {args.duration}s | "
+        f"busy_timeout: {args.busy_timeout}ms | retries: {args.retries} | backoff: {args.backoff}s | "
+        f"journal_mode: {args.journal_mode or 'padrão'}"
+    )
+    cab = f"{'operação':<10} {'ops':>7} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'lock %':>8} {'erro %':>8}"
+    print(cab)
+    print("-" * len(cab))
+    linhas = list(resumo["por_operacao"].items()) + [("TOTAL", resumo["total"])]
+    for nome, s in linhas:
+        print(
+            f"{nome:<10} {s['ops']:>7} {s['throughput_ops_s']:>9.1f} {s['p50_ms']:>9.1f} "
+            f"{s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f} {s['lock_error_rate'] * 100:>7.2f}% "
+            f"{s['other_error_rate'] * 100:>7.2f}%"
+        )
+    print(f"Retentativas por bloqueio: {resumo['retries']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Teste de carga concorrente do fallback SQLite.")
+    parser.add_argument("--db", help="Arquivo SQLite de partida; o teste roda sobre uma cópia temporária dele "
+                                     "(padrão: banco temporário populado com --seed-rows).")
+    parser.add_argument("--in-place", action="store_true",
+                        help="Com --db, roda direto no arquivo (o teste insere, altera e exclui transações).")
+    parser.add_argument("--sessions", type=int, default=8, help="Número de sessões concorrentes.")
+    parser.add_argument("--mode", choices=["thread", "process"], default="thread")
+    parser.add_argument("--duration", type=float, default=10.0, help="Duração em segundos.")
+    parser.add_argument("--seed-rows", type=int, default=5000, help="Transações iniciais no banco temporário.")
+    parser.add_argument("--busy-timeout", type=int, default=int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+                        help="PRAGMA busy_timeout em ms (mesmo significado de SQLITE_BUSY_TIMEOUT_MS).")
+    parser.add_argument("--retries", type=int, default=int(os.environ.get("SQLITE_MAX_RETRIES", "5")))
+    parser.add_argument("--backoff", type=float, default=float(os.environ.get("SQLITE_RETRY_BACKOFF", "0.05")))
+    parser.add_argument("--journal-mode", default=os.environ.get("SQLITE_JOURNAL_MODE", ""),
+                        help="Ex: WAL, DELETE. Vazio mantém o modo do arquivo.")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Pausa média entre operações (s).")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="Imprime o resumo em JSON.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.in_place and not args.db:
+        raise SystemExit("--in-place exige --db.")
+    tmpdir = None
+    if not args.in_place:
+        tmpdir = tempfile.TemporaryDirectory()
+        destino = os.path.join(tmpdir.name, "financeiro_carga.db")
+        if args.db:
+            if not os.path.exists(args.db):
+                raise SystemExit(f"Arquivo não encontrado: {args.db}")
+            copy_database(args.db, destino)
+        else:
+            seed_database(destino, args.seed_rows, args.journal_mode)
+        args.db = destino
+    if args.journal_mode:
+        db_conn = sqlite3.connect(args.db)
+        db_conn.execute(f"PRAGMA journal_mode = {args.journal_mode}")
+        db_conn.close()
+
+    inicio = time.time()
+    resultados = run_load(args)
+    resumo = summarize(resultados, time.time() - inicio)
+
+    if args.json:
+        print(json.dumps(resumo, indent=2, ensure_ascii=False))
+    else:
+        print_report(resumo, args)
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()